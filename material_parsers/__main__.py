@@ -1,6 +1,6 @@
 import argparse
 
-from material_parsers.service import init
+from material_parsers.service import init, run_production
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -9,6 +9,19 @@ if __name__ == '__main__':
     parser.add_argument("--host", required=False, default='0.0.0.0', help="Hostname.")
     parser.add_argument("--port", required=False, default=8080, help="Listening port.")
     parser.add_argument("--config", required=False, help="Path to the configuration file.")
+    parser.add_argument("--production", required=False, default=False, action="store_true",
+                        help="Serve with multiple pre-forked worker processes (requires gunicorn).")
+    parser.add_argument("--workers", required=False, type=int, default=None,
+                        help="Number of worker processes in production mode. Default: number of CPUs.")
+    parser.add_argument("--threads", required=False, type=int, default=1,
+                        help="Number of request threads per worker process in production mode.")
+    parser.add_argument("--backlog", required=False, type=int, default=2048,
+                        help="Maximum number of pending connections in production mode.")
+    parser.add_argument("--graceful-timeout", required=False, type=int, default=30,
+                        help="Seconds given to the workers to complete the running requests at shutdown.")
+    parser.add_argument("--timeout", required=False, type=int, default=300,
+                        help="Seconds of silence (e.g. loading the models) after which a worker is restarted in "
+                             "production mode.")
 
     args = parser.parse_args()
 
@@ -16,4 +29,8 @@ if __name__ == '__main__':
     port = args.port
     config = args.config
 
-    init(host, port, config)
+    if args.production:
+        run_production(host, port, config, workers=args.workers, threads=args.threads, backlog=args.backlog,
+                       graceful_timeout=args.graceful_timeout, timeout=args.timeout)
+    else:
+        init(host, port, config)
@@ -0,0 +1,291 @@
+"""
+Offline processing of large collections of material mentions with the ML material parser, without the service.
+
+    python -m material_parsers.batch --input mentions.jsonl --output parsed/ --workers 8
+
+The input is split in chunks of --chunk-size lines, which are processed by a pool of worker processes, each
+loading the models once. The results of each chunk are written to its own file in the output directory
+(part-00000.jsonl, ...) once the whole chunk is processed: when the command is run again on the same output
+directory, the chunks already written are skipped.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from tqdm import tqdm
+
+INPUT_FORMATS = ["jsonl", "tsv"]
+OUTPUT_FORMATS = ["jsonl", "parquet"]
+
+MANIFEST_FILE = "_manifest.json"
+
+# Options and models of the worker process, set by init_worker()
+_worker_options = None
+_worker_parser = None
+
+
+def get_input_format(input_path):
+    extension = os.path.splitext(input_path)[1].lower().lstrip(".")
+    return "tsv" if extension in ["tsv", "tab"] else "jsonl"
+
+
+def read_header(input_path, input_format):
+    """Return the column names and the offset of the first record (after the header, for TSV). """
+    if input_format != "tsv":
+        return None, 0
+
+    with open(input_path, 'rb') as fp:
+        header = fp.readline()
+    return next(csv.reader([header.decode('utf-8').rstrip("\r\n")], delimiter="\t")), len(header)
+
+
+def find_chunks(input_path, start_offset=0, chunk_size=10000):
+    """Scan the input once and return the (byte offset, number of lines) of each chunk of chunk_size lines. """
+    chunks = []
+    with open(input_path, 'rb') as fp:
+        fp.seek(start_offset)
+        offset = start_offset
+        chunk_start = offset
+        lines = 0
+        for line in fp:
+            offset += len(line)
+            lines += 1
+            if lines == chunk_size:
+                chunks.append((chunk_start, lines))
+                chunk_start = offset
+                lines = 0
+        if lines > 0:
+            chunks.append((chunk_start, lines))
+
+    return chunks
+
+
+def parse_record(line, input_format, header=None, text_field="text"):
+    """
+    Return the record of a line of input as a dict containing text_field, or None for an empty line.
+    The JSONL lines can be strings, objects or plain text, the TSV lines are mapped to the columns of the header.
+    """
+    line = line.rstrip("\r\n")
+    if not line.strip():
+        return None
+
+    if input_format == "tsv":
+        values = next(csv.reader([line], delimiter="\t"))
+        return dict(zip(header, values))
+
+    try:
+        value = json.loads(line)
+    except ValueError:
+        return {text_field: line}
+
+    if type(value) is dict:
+        return value
+    if type(value) is str:
+        return {text_field: value}
+
+    return {text_field: line}
+
+
+def read_chunk(input_path, offset, lines, input_format, header=None, text_field="text"):
+    records = []
+    with open(input_path, 'rb') as fp:
+        fp.seek(offset)
+        for _ in range(lines):
+            record = parse_record(fp.readline().decode('utf-8'), input_format, header, text_field)
+            if record is not None:
+                records.append(record)
+
+    return records
+
+
+def get_part_path(output_path, chunk_index, output_format):
+    return os.path.join(output_path, "part-{:05d}.{}".format(chunk_index, output_format))
+
+
+def write_part(path, records, output_format):
+    """Write the records to a temporary file, renamed at the end, so that a part is never partially written. """
+    temporary_path = path + ".tmp"
+    if output_format == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("The parquet output requires pyarrow. Install it with 'pip install pyarrow'.")
+
+        # The materials have a variable structure, they are stored as JSON strings
+        rows = [dict(record, materials=json.dumps(record['materials'])) for record in records]
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), temporary_path)
+    else:
+        with open(temporary_path, 'w', encoding='utf-8') as fp:
+            for record in records:
+                fp.write(json.dumps(record) + "\n")
+
+    os.replace(temporary_path, path)
+
+
+def get_manifest(input_path, input_format, output_format, chunk_size, text_field, configuration, model_path):
+    """
+    Return the parameters of the run that change the output: a run can be resumed only with the same parameters,
+    including the model and the configuration of the parsers (length buckets, variable expansions, ...).
+    """
+    return {
+        "input": os.path.abspath(input_path),
+        "input-format": input_format,
+        "output-format": output_format,
+        "chunk-size": chunk_size,
+        "text-field": text_field,
+        "model-path": os.path.abspath(model_path),
+        "formula-parser": configuration.get('formula-parser', {}),
+        "material-parser": configuration.get('material-parser', {})
+    }
+
+
+def check_manifest(output_path, manifest):
+    """Write the manifest of the run, or verify that the run to resume was started with the same parameters. """
+    manifest_path = os.path.join(output_path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fp:
+            previous_manifest = json.load(fp)
+        if previous_manifest != manifest:
+            raise ValueError("The output directory " + output_path + " contains the results of a run with different "
+                                                                     "parameters: " + json.dumps(previous_manifest))
+    else:
+        with open(manifest_path, 'w') as fp:
+            json.dump(manifest, fp, indent=4)
+
+
+def init_worker(options):
+    """Load the models once per worker process. """
+    global _worker_options, _worker_parser
+
+    # Imported here, so that the main process does not load TensorFlow
+    from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas
+    from material_parsers.material_parser.material_parser_ml import MaterialParserML, DEFAULT_LENGTH_BUCKETS, \
+        DEFAULT_MAX_VARIABLE_EXPANSIONS
+
+    configuration = options['configuration']
+    formula_parser_configuration = configuration.get('formula-parser', {})
+    ml_configuration = configuration.get('material-parser', {})
+
+    # The formulas are parsed in the worker itself: a pool worker cannot start the timeout processes
+    formula_parser = MaterialParserFormulas(cache_size=formula_parser_configuration.get('cache-size', 10000))
+    _worker_parser = MaterialParserML(formula_parser, model_path=options['model_path'],
+                                      length_buckets=ml_configuration.get('length-buckets', DEFAULT_LENGTH_BUCKETS),
+                                      max_variable_expansions=ml_configuration.get('max-variable-expansions',
+                                                                                   DEFAULT_MAX_VARIABLE_EXPANSIONS),
+                                      symbolic_substitution=ml_configuration.get('symbolic-substitution', False))
+    _worker_options = options
+
+
+def process_chunk(chunk):
+    chunk_index, offset, lines = chunk
+    options = _worker_options
+    text_field = options['text_field']
+
+    records = read_chunk(options['input_path'], offset, lines, options['input_format'], options['header'],
+                         text_field)
+    results = _worker_parser.process([str(record.get(text_field, "")) for record in records])
+    for record, materials in zip(records, results):
+        record['materials'] = materials
+
+    write_part(get_part_path(options['output_path'], chunk_index, options['output_format']), records,
+               options['output_format'])
+
+    return chunk_index, lines
+
+
+def run(input_path, output_path, input_format=None, output_format="jsonl", workers=1, chunk_size=10000,
+        text_field="text", configuration=None, model_path="resources/data/models"):
+    """
+    Process the input file and write the results in the output directory, skipping the chunks already written
+    by a previous run. Return the number of lines processed.
+    """
+    input_format = input_format if input_format else get_input_format(input_path)
+    if input_format not in INPUT_FORMATS:
+        raise ValueError("Unknown input format " + str(input_format) + ", use one of " + str(INPUT_FORMATS))
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format " + str(output_format) + ", use one of " + str(OUTPUT_FORMATS))
+
+    os.makedirs(output_path, exist_ok=True)
+    configuration = configuration if configuration is not None else {}
+    check_manifest(output_path, get_manifest(input_path, input_format, output_format, chunk_size, text_field,
+                                             configuration, model_path))
+
+    header, start_offset = read_header(input_path, input_format)
+    if header is not None and text_field not in header:
+        raise ValueError("The column " + text_field + " is not in the header of " + input_path)
+
+    chunks = find_chunks(input_path, start_offset, chunk_size)
+    pending_chunks = [(index, offset, lines) for index, (offset, lines) in enumerate(chunks)
+                      if not os.path.exists(get_part_path(output_path, index, output_format))]
+
+    total_lines = sum(lines for _, lines in chunks)
+    done_lines = total_lines - sum(lines for _, _, lines in pending_chunks)
+    if done_lines > 0:
+        print("Resuming: {} of {} chunks already processed.".format(len(chunks) - len(pending_chunks), len(chunks)))
+
+    options = {
+        'input_path': input_path,
+        'input_format': input_format,
+        'header': header,
+        'text_field': text_field,
+        'output_path': output_path,
+        'output_format': output_format,
+        'configuration': configuration,
+        'model_path': model_path
+    }
+
+    start = time.time()
+    processed_lines = 0
+    with tqdm(total=total_lines, initial=done_lines, unit="lines") as progress:
+        if pending_chunks:
+            # Spawned (not forked) processes, TensorFlow cannot be shared between processes
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(min(workers, len(pending_chunks)), initializer=init_worker,
+                              initargs=(options,)) as pool:
+                for _, lines in pool.imap_unordered(process_chunk, pending_chunks):
+                    processed_lines += lines
+                    progress.update(lines)
+
+    elapsed = time.time() - start
+    print("Processed {} lines in {:.1f} seconds ({:.1f} lines/s), results in {}".format(
+        processed_lines, elapsed, processed_lines / elapsed if elapsed > 0 else 0, output_path))
+
+    return processed_lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Process a large file of material mentions with the material parser, using multiple processes.")
+
+    parser.add_argument("--input", required=True, help="Input file, JSONL (one string or object per line) or TSV "
+                                                       "(with header).")
+    parser.add_argument("--output", required=True, help="Output directory. If it contains the results of a previous "
+                                                        "run, the processing is resumed.")
+    parser.add_argument("--input-format", required=False, default=None, choices=INPUT_FORMATS,
+                        help="Format of the input. Default: from the file extension.")
+    parser.add_argument("--output-format", required=False, default="jsonl", choices=OUTPUT_FORMATS,
+                        help="Format of the output files (parquet requires pyarrow).")
+    parser.add_argument("--text-field", required=False, default="text",
+                        help="Field (JSONL) or column (TSV) containing the text to process.")
+    parser.add_argument("--workers", required=False, type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes. Default: number of CPUs.")
+    parser.add_argument("--chunk-size", required=False, type=int, default=10000,
+                        help="Number of lines of each chunk, which is the unit of work and of checkpointing.")
+    parser.add_argument("--config", required=False, help="Path to the configuration file.")
+    parser.add_argument("--model-path", required=False, default="resources/data/models",
+                        help="Directory of the material parser model.")
+
+    args = parser.parse_args()
+
+    configuration = {}
+    if args.config and os.path.exists(args.config):
+        with open(args.config, 'r') as fp:
+            configuration = json.load(fp)
+
+    run(args.input, args.output, input_format=args.input_format, output_format=args.output_format,
+        workers=args.workers, chunk_size=args.chunk_size, text_field=args.text_field, configuration=configuration,
+        model_path=args.model_path)
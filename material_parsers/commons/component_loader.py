@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Component:
+    def __init__(self, name):
+        self.name = name
+        self.done = threading.Event()
+        self.error = None
+        self.load_time = None
+
+    @property
+    def ready(self):
+        return self.done.is_set() and self.error is None
+
+
+class ComponentLoader:
+    """
+    Load the components of the service (models, pipelines, ...) by calling their load function.
+
+    In background mode each component is loaded in its own thread, after the components it requires, and
+    load() returns immediately: the callers check with not_ready() whether the components they need are
+    available. Otherwise the components are loaded one after the other and the errors are raised.
+    """
+
+    def __init__(self, background=False):
+        self.background = background
+        self.components = OrderedDict()
+        self.start_time = time.time()
+
+    def load(self, name, function, requires=()):
+        component = _Component(name)
+        dependencies = [self.components[dependency] for dependency in requires]
+        self.components[name] = component
+
+        if self.background:
+            threading.Thread(target=self._load, args=(component, function, dependencies), name="load-" + name,
+                             daemon=True).start()
+        else:
+            self._load(component, function, dependencies)
+
+    def _load(self, component, function, dependencies):
+        for dependency in dependencies:
+            dependency.done.wait()
+            if dependency.error is not None:
+                component.error = "The required component " + dependency.name + " could not be loaded."
+                component.done.set()
+                return
+
+        start = time.time()
+        try:
+            function()
+        except Exception as e:
+            component.error = type(e).__name__ + ": " + str(e)
+            print("The component", component.name, "could not be loaded:", component.error)
+            if not self.background:
+                raise
+        finally:
+            component.load_time = time.time() - start
+            component.done.set()
+
+        if component.error is None:
+            print("Loaded {} in {:.1f} seconds".format(component.name, component.load_time))
+
+    def not_ready(self, names):
+        """Return the components among names that are still loading or could not be loaded. """
+        return [name for name in names if name in self.components and not self.components[name].ready]
+
+    def failed(self, names):
+        return [name for name in names if name in self.components and self.components[name].error is not None]
+
+    def wait(self, timeout=None):
+        """Wait until all the components are loaded (or failed), return whether they are all ready. """
+        deadline = time.time() + timeout if timeout is not None else None
+        for component in self.components.values():
+            component.done.wait(None if deadline is None else max(0.0, deadline - time.time()))
+
+        return all(component.ready for component in self.components.values())
+
+    def status(self):
+        return {
+            "ready": all(component.ready for component in self.components.values()),
+            "uptime": round(time.time() - self.start_time, 2),
+            "components": {
+                name: {
+                    "ready": component.ready,
+                    "loading": not component.done.is_set(),
+                    "load_time": round(component.load_time, 2) if component.load_time is not None else None,
+                    "error": component.error
+                } for name, component in self.components.items()
+            }
+        }
@@ -0,0 +1,77 @@
+import gzip
+import zlib
+
+from bottle import request, response
+
+GZIP = "gzip"
+DEFLATE = "deflate"
+
+
+def select_encoding(accept_encoding):
+    """
+    Return the content coding to use among gzip and deflate according to the Accept-Encoding header, or None.
+    The coding with the highest quality is selected, gzip when both have the same.
+    """
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+
+    wildcard = qualities.get("*", 0.0)
+    candidates = [(qualities.get(coding, wildcard), -index, coding) for index, coding in enumerate([GZIP, DEFLATE])]
+    quality, _, coding = max(candidates)
+
+    return coding if quality > 0 else None
+
+
+def compress(body, coding, level=6):
+    if coding == GZIP:
+        return gzip.compress(body, compresslevel=level)
+    return zlib.compress(body, level)
+
+
+class CompressionPlugin:
+    """
+    Bottle plugin compressing the responses with gzip or deflate, when accepted by the client.
+
+    Only the complete responses (strings or bytes) of at least min_size bytes are compressed, the streamed
+    responses are sent as they are.
+    """
+    name = "compression"
+    api = 2
+
+    def __init__(self, min_size=1024, level=6):
+        self.min_size = min_size
+        self.level = level
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            return self.compress_response(callback(*args, **kwargs))
+
+        return wrapper
+
+    def compress_response(self, body):
+        if type(body) not in [str, bytes] or 'Content-Encoding' in response.headers:
+            return body
+
+        if type(body) is str:
+            body = body.encode(response.charset or 'utf-8')
+
+        if len(body) < self.min_size:
+            return body
+
+        response.add_header('Vary', 'Accept-Encoding')
+        coding = select_encoding(request.headers.get('Accept-Encoding', ''))
+        if coding is None:
+            return body
+
+        response.set_header('Content-Encoding', coding)
+        return compress(body, coding, self.level)
@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+
+
+class _PendingRequest:
+    def __init__(self, items):
+        self.items = items
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Coalesce the items submitted by concurrent callers into a single call of a batch function.
+
+    A background thread collects the pending requests until either max_batch_size items are collected or
+    max_wait_ms milliseconds have passed since the first request of the batch arrived. The batch function
+    is then called once with all the items and the results are scattered back to each caller, in order.
+
+    The batch function must return one result per item.
+    """
+
+    def __init__(self, batch_function, max_batch_size=32, max_wait_ms=5):
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_achieved_batch_size = 0
+        self.batch_sizes = defaultdict(int)
+
+        self.worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, items):
+        """Submit a list of items and block until their results are available."""
+        if not items:
+            return []
+
+        request = _PendingRequest(items)
+        self.queue.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "average_batch_size": round(self.items / self.batches, 2) if self.batches > 0 else 0,
+                "max_batch_size": self.max_achieved_batch_size,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())}
+            }
+
+    def _collect(self):
+        pending = [self.queue.get()]
+        size = len(pending[0].items)
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(request)
+            size += len(request.items)
+
+        return pending, size
+
+    def _run(self):
+        while True:
+            pending, size = self._collect()
+            batch = [item for request in pending for item in request.items]
+
+            try:
+                results = self.batch_function(batch)
+                if len(results) != len(batch):
+                    raise RuntimeError("The batch function returned " + str(len(results)) + " results for "
+                                       + str(len(batch)) + " items.")
+                offset = 0
+                for request in pending:
+                    request.result = results[offset: offset + len(request.items)]
+                    offset += len(request.items)
+            except Exception as e:
+                for request in pending:
+                    request.error = e
+
+            with self.lock:
+                self.batches += 1
+                self.items += size
+                self.batch_sizes[size] += 1
+                self.max_achieved_batch_size = max(self.max_achieved_batch_size, size)
+
+            for request in pending:
+                request.done.set()
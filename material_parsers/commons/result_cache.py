@@ -0,0 +1,149 @@
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of JSON-serialisable results, addressed by the hash of the input text and a namespace
+    (e.g. the model version), so that a new model never reads results of the previous one.
+
+    The results are stored serialised and deserialised at every read: the callers always get a fresh copy,
+    identical to the result originally stored.
+
+    When a path is provided, the entries are also written to a SQLite database, which is used as second tier
+    and survives restarts. The database can be shared between worker processes.
+    """
+
+    def __init__(self, max_size=100000, namespace="", path=None):
+        self.max_size = max_size
+        self.namespace = namespace
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def key(self, text):
+        return hashlib.sha256((self.namespace + "\0" + text).encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        """Return the result stored for the text or None."""
+        key = self.key(text)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(value)
+
+            if self.db is not None:
+                row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._store(key, row[0])
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def put(self, text, result):
+        key = self.key(text)
+        value = json.dumps(result)
+        with self.lock:
+            self._store(key, value)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, value))
+
+    def _store(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.disk_hits) / requests, 4) if requests > 0 else 0
+            }
+
+
+class Memoizer:
+    """
+    Bounded LRU memoization of a single-argument function returning JSON-like objects (copied at every read).
+
+    The inputs raising one of the negative_exceptions are remembered in a separate (bounded) cache, and the same
+    exception is raised again without calling the function.
+    """
+
+    def __init__(self, function, max_size=10000, negative_max_size=10000, negative_exceptions=(ValueError,)):
+        self.function = function
+        self.max_size = max_size
+        self.negative_max_size = negative_max_size
+        self.negative_exceptions = negative_exceptions
+
+        self.results = OrderedDict()
+        self.errors = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def __call__(self, argument):
+        with self.lock:
+            if argument in self.results:
+                self.results.move_to_end(argument)
+                self.hits += 1
+                return copy.deepcopy(self.results[argument])
+
+            if argument in self.errors:
+                self.errors.move_to_end(argument)
+                self.negative_hits += 1
+                error_type, error_args = self.errors[argument]
+                raise error_type(*error_args)
+
+            self.misses += 1
+
+        try:
+            result = self.function(argument)
+        except self.negative_exceptions as e:
+            with self.lock:
+                # The exception itself is not kept, as it references the frames of the traceback
+                self.errors[argument] = (type(e), e.args)
+                while len(self.errors) > self.negative_max_size:
+                    self.errors.popitem(last=False)
+            raise
+
+        with self.lock:
+            self.results[argument] = copy.deepcopy(result)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.results),
+                "negative_size": len(self.errors),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,61 @@
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonSerializer:
+    """
+    Serialisation of the JSON responses and requests, with orjson when it is installed, or the standard library.
+
+    The output is compact, unless pretty is requested. The objects that orjson does not support (e.g. integers
+    larger than 64 bits), and the non-finite floats, which orjson writes as null instead of NaN or Infinity, are
+    serialised with the standard library.
+    """
+    AUTO = "auto"
+    ORJSON = "orjson"
+    STANDARD = "json"
+
+    def __init__(self, library=AUTO):
+        if library not in [self.AUTO, self.ORJSON, self.STANDARD]:
+            raise ValueError("Unknown JSON library " + str(library) + ", use one of "
+                             + str([self.AUTO, self.ORJSON, self.STANDARD]))
+        if library == self.ORJSON and orjson is None:
+            raise ValueError("The JSON library orjson is not installed.")
+
+        self.library = self.ORJSON if library != self.STANDARD and orjson is not None else self.STANDARD
+
+    def dumps(self, data, pretty=False) -> str:
+        if pretty:
+            return json.dumps(data, indent=4)
+
+        if self.library == self.ORJSON:
+            try:
+                output = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+                # The payload is checked only when there is a null, which might be a non-finite float
+                if b"null" not in output or not has_non_finite_float(data):
+                    return output.decode('utf-8')
+            except orjson.JSONEncodeError:
+                pass
+
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(self, text):
+        """Parse a JSON document, raise ValueError when it is not valid. """
+        if self.library == self.ORJSON:
+            return orjson.loads(text)
+
+        return json.loads(text)
+
+
+def has_non_finite_float(data):
+    if type(data) is float:
+        return not math.isfinite(data)
+    if isinstance(data, dict):
+        return any(has_non_finite_float(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return any(has_non_finite_float(value) for value in data)
+    return False
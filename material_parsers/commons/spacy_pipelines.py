@@ -0,0 +1,69 @@
+import spacy
+
+
+class PipelineView:
+    """
+    A spaCy pipeline restricted to some of the components of a shared Language object.
+
+    It can be used in place of the Language object for processing (__call__, pipe) and for accessing the
+    vocabulary and the components. The shared object is never modified, so that the views can be used
+    concurrently.
+    """
+
+    def __init__(self, nlp, components):
+        self.nlp = nlp
+        self.pipe_names = [name for name in nlp.pipe_names if name in components]
+        self.disabled = [name for name in nlp.pipe_names if name not in self.pipe_names]
+
+    @property
+    def vocab(self):
+        return self.nlp.vocab
+
+    def get_pipe(self, name):
+        if name not in self.pipe_names:
+            raise KeyError("The component " + name + " is not in the pipeline " + str(self.pipe_names))
+        return self.nlp.get_pipe(name)
+
+    def __call__(self, text):
+        return self.nlp(text, disable=self.disabled)
+
+    def pipe(self, texts, disable=None, **kwargs):
+        disable = self.disabled + [name for name in (disable if disable is not None else []) if
+                                   name not in self.disabled]
+        return self.nlp.pipe(texts, disable=disable, **kwargs)
+
+
+class SpacyPipelineManager:
+    """
+    Load a spaCy model once and share its vocabulary and weights between named views, each running only the
+    components needed by one task.
+
+    The components (e.g. the entity rulers) must be added before the views using them are created.
+    """
+    # Tagger and parser for the linking, as the model loaded with ner, textcat and lemmatizer disabled
+    LINKING = "linking"
+    LINKING_COMPONENTS = ["tok2vec", "tagger", "parser", "attribute_ruler"]
+
+    # Lemmatizer and entity rulers for the structures, as the model loaded with parser, textcat and ner disabled
+    STRUCTURE = "structure"
+    STRUCTURE_EXCLUDED_COMPONENTS = ["parser", "textcat", "ner"]
+
+    def __init__(self, model="en_core_web_sm"):
+        self.nlp = spacy.load(model)
+        self.views = {}
+
+    def add_entity_ruler(self, name, patterns_path):
+        entity_ruler = self.nlp.add_pipe("entity_ruler", name)
+        entity_ruler.from_disk(patterns_path)
+
+    def add_view(self, name, components):
+        self.views[name] = PipelineView(self.nlp, components)
+        return self.views[name]
+
+    def add_default_views(self):
+        self.add_view(self.LINKING, self.LINKING_COMPONENTS)
+        self.add_view(self.STRUCTURE, [name for name in self.nlp.pipe_names
+                                       if name not in self.STRUCTURE_EXCLUDED_COMPONENTS])
+
+    def get_view(self, name):
+        return self.views[name]
@@ -0,0 +1,76 @@
+import codecs
+import json
+
+
+def iter_lines(stream, content_length=None, chunk_size=64 * 1024):
+    """
+    Read a binary stream incrementally and yield its lines decoded as UTF-8, without the line terminator.
+
+    At most content_length bytes are read when given, otherwise the stream is read until its end (the WSGI
+    server is expected to have decoded the chunked transfer encoding). Only one chunk and the current
+    incomplete line are kept in memory.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remaining = content_length if content_length is not None and content_length >= 0 else None
+    pending = ""
+
+    while remaining is None or remaining > 0:
+        chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+def is_chunked_body_undecoded(environ):
+    """
+    Return whether the body is sent with the chunked transfer encoding to a server that does not decode it: the
+    wsgiref server (the development server of bottle) passes the chunks as they are, unlike gunicorn.
+    """
+    return 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower() and \
+        environ.get('SERVER_SOFTWARE', '').startswith('WSGIServer/')
+
+
+def parse_text_line(line):
+    """
+    Return the text of a line of NDJSON or plain text input, or None for an empty line.
+
+    A JSON line can be a string or an object with a "text" field; any other line is taken as it is.
+    """
+    stripped = line.strip()
+    if not stripped:
+        return None
+
+    if stripped[0] in '{"':
+        try:
+            value = json.loads(stripped)
+        except ValueError:
+            return line
+        if type(value) is str:
+            return value
+        if type(value) is dict and type(value.get("text")) is str:
+            return value["text"]
+
+    return line
+
+
+def iter_batches(items, batch_size):
+    """Group the items of an iterable in lists of at most batch_size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
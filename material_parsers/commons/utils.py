@@ -1,4 +1,5 @@
 import difflib
+import functools
 import re
 
 ALLOWED_CHARS_MATERIAL_PARSER = ['', 'g', 'S', '7', 'j', 'X', 'w', 'υ', ')', 'h', 'α', 'y', 'v', '1', 'O', '·', 'r', 'ς', 'p', 'b', 'E', 'B', 'd', 'ω', 'Z', 'β', '□', 'ε', 'c', 'J', 'R', 'U', 'q', 'n', 'u', '9', 'Q', 'H', 't', '0', 'N', 'Y', 'ψ', '5', 'o', 'M', 'T', 'ο', 'G', '8', 'σ', 'φ', 'A', '∓', 'τ', 'I', 'μ', 'λ', 'x', 'f', 'η', 'θ', '.', '+', '/', '2', 'K', 'e', 'χ', '3', 's', 'l', 'm', 'V', '(', 'P', 'ρ', '*', 'ν', 'F', 'γ', 'π', 'ξ', '±', 'k', '-', 'δ', 'L', 'ζ', 'W', 'D', 'a', 'i', 'κ', 'ι', 'C', 'z', ',', '4', '6']
@@ -6,7 +7,36 @@ ALLOWED_CHARS_MATERIAL_PARSER = ['', 'g', 'S', '7', 'j', 'X', 'w', 'υ', ')', 'h
 def find_closest_character(input_char, allowed_chars):
     return difflib.get_close_matches(input_char, allowed_chars, n=1, cutoff=0.8)
 
+
+def build_closest_character_table(allowed_chars, cutoff=0.8):
+    """
+    Build the str.translate() table equivalent to find_closest_character() applied to each character.
+
+    The difflib ratio between a character and an allowed entry of length L is 2 / (1 + L) when the entry contains
+    the character, and 0 otherwise. Therefore, only the characters appearing in the allowed entries can have a
+    close match, and any other character is kept as it is.
+    """
+    table = {}
+    for char in set("".join(allowed_chars)):
+        closest_match = difflib.get_close_matches(char, allowed_chars, n=1, cutoff=cutoff)
+        if closest_match and closest_match[0] != char:
+            table[ord(char)] = closest_match[0]
+
+    return table
+
+
+@functools.lru_cache(maxsize=16)
+def get_closest_character_table(allowed_chars: tuple):
+    return build_closest_character_table(list(allowed_chars))
+
+
+CLOSEST_CHARS_MATERIAL_PARSER_TABLE = get_closest_character_table(tuple(ALLOWED_CHARS_MATERIAL_PARSER))
+
+
 def replace_with_closest(input_list, allowed_chars):
+    if type(input_list) is str:
+        return input_list.translate(get_closest_character_table(tuple(allowed_chars)))
+
     result_list = []
 
     for char in input_list:
@@ -1,5 +1,5 @@
-import copy
 import json
+from bisect import bisect_left
 
 import spacy
 from blingfire import text_to_sentences
@@ -61,7 +61,32 @@ class SpacyPipeline:
     def init_doc(self, words, spaces, spans):
         ## Creating a new document with the text
         doc = Doc(self.nlp.vocab, words=words, spaces=spaces)
+        self.nlp.get_pipe("tagger")(doc)
+        self.nlp.get_pipe("parser")(doc)
 
+        return self.merge_entities(doc, spans)
+
+    def init_docs(self, sentences, batch_size=None, n_process=1):
+        """
+        Same as init_doc() for a list of (words, spaces, spans), running the tagger and the parser in batches
+        through nlp.pipe(), in n_process processes
+        """
+        docs = (Doc(self.nlp.vocab, words=words, spaces=spaces) for words, spaces, _ in sentences)
+        disable = [name for name in self.nlp.pipe_names if name not in ["tagger", "parser"]]
+        parsed_docs = self.nlp.pipe(docs, batch_size=batch_size, n_process=n_process, disable=disable)
+
+        return [self.merge_entities(doc, spans) for doc, (_, _, spans) in zip(parsed_docs, sentences)]
+
+    def init_doc_without_parsing(self, words, spaces, spans):
+        """
+        Same as init_doc(), with the entities merged, but without tagger and parser (and therefore without merging
+        the noun phrases)
+        """
+        doc = Doc(self.nlp.vocab, words=words, spaces=spaces)
+
+        return self.merge_entities(doc, spans, merge_phrases=False)
+
+    def merge_entities(self, doc, spans, merge_phrases=True):
         ## Loading GROBID entities in the spaCY document
         entities = []
         for s in spans:
@@ -92,11 +117,9 @@ class SpacyPipeline:
                     token._.formattedText = span._.formattedText
                     token._.links = span._.links
                     token._.linkable = span._.linkable
-            self.nlp.get_pipe("tagger")(doc)
-            self.nlp.get_pipe("parser")(doc)
             ## Merge entities and phrase nouns, but only when they are not overlapping,
             # to avoid loosing the entity type information
-            phrases_ents = self.extract_phrases_ents(doc)
+            phrases_ents = self.extract_phrases_ents(doc) if merge_phrases else []
             # print(phrases_ents)
             for span in phrases_ents:
                 # print("Span " + str(span))
@@ -120,27 +143,54 @@ class SpacyPipeline:
 
         return doc
 
-    def get_sentence_boundaries(self, words, spaces):
+    def get_sentence_boundaries(self, words, spaces, return_offsets=False):
+        """
+        Return the boundaries (token start, token end) of the sentences found by blingfire.
+        With return_offsets=True, the character offsets of the sentences in the text are added:
+        (token start, token end, offset start, offset end).
+        """
+        ## Character offset of each token, and position of the last non-whitespace character up to the end
+        # of each token (spaces included)
+        token_offsets = []
+        last_non_whitespace = []
         offset = 0
-        reconstructed = ''
-        sentence_offsetTokens = []
+        last = -1
+        for word, space in zip(words, spaces):
+            token_offsets.append(offset)
+            stripped_length = len(word.rstrip())
+            if stripped_length > 0:
+                last = offset + stripped_length - 1
+            last_non_whitespace.append(last)
+            offset += len(word) + (1 if space else 0)
+
         text = ''.join([words[i] + (' ' if spaces[i] else '') for i in range(0, len(words))])
 
+        sentence_offsetTokens = []
+        start = 0
         for sent in text_to_sentences(text).split('\n'):
-            start = offset
-
-            for id in range(offset, len(words)):
-                token = words[id]
-                reconstructed += token
-                if spaces[id]:
-                    reconstructed += ' '
-                if len(reconstructed.rstrip()) == len(sent):
-                    offset += 1
-                    end = offset
-                    sentence_offsetTokens.append((start, end))
-                    reconstructed = ''
-                    break
-                offset += 1
+            if start >= len(words):
+                break
+            offset_start = token_offsets[start]
+
+            ## The sentence ends at the first token where the text from the sentence start, without trailing
+            # whitespaces, is as long as the sentence
+            if len(sent) == 0:
+                end = start
+            else:
+                end = bisect_left(last_non_whitespace, offset_start + len(sent) - 1, lo=start)
+
+            if end < len(words) and max(0, last_non_whitespace[end] + 1 - offset_start) == len(sent):
+                if return_offsets:
+                    # blingfire strips the whitespaces at the start of the sentence
+                    sentence_start = offset_start
+                    while sentence_start < len(text) and text[sentence_start].isspace():
+                        sentence_start += 1
+                    sentence_offsetTokens.append((start, end + 1, sentence_start, sentence_start + len(sent)))
+                else:
+                    sentence_offsetTokens.append((start, end + 1))
+                start = end + 1
+            else:
+                start = len(words)
 
         return sentence_offsetTokens
 
@@ -154,11 +204,20 @@ class SpacyPipeline:
 
         return outputTokens, outputSpaces
 
+    @staticmethod
+    def copy_span(span):
+        span_copy = dict(span)
+        if 'links' in span_copy:
+            span_copy['links'] = list(span_copy['links'])
+        return span_copy
+
     @staticmethod
     def convert_to_spacy(tokens, spans):
         """
         Converts the list of tokens and spans into Spacy made Tokens, Spaces and Spans that can be used to 
         build the Spacy document.
+        The input is not modified: the remapped spans are shallow copies of the input spans, with their own list
+        of links.
         """
         outputTokens = []
         outputSpaces = []
@@ -170,7 +229,7 @@ class SpacyPipeline:
         entityOffset = 0
         inside = False
         if len(spans) > 0:
-            span = spans[entityOffset]
+            span = SpacyPipeline.copy_span(spans[entityOffset])
 
         for index, s in enumerate(tokens):
             if len(spans) > 0:
@@ -183,7 +242,7 @@ class SpacyPipeline:
                     inside = False
                     if entityOffset + 1 < len(spans):
                         entityOffset += 1
-                        span = spans[entityOffset]
+                        span = SpacyPipeline.copy_span(spans[entityOffset])
                         if index == span['token_start']:
                             span['token_start'] = newIndexOffset
                             inside = True
@@ -297,11 +356,89 @@ class SpacyPipeline:
         return phrases_ents
 
 
+class ParagraphAnalysis:
+    """
+    Analysis of a paragraph shared between the temperature classifier and the linkers: the conversion to the
+    spaCy tokenisation, the tagging and the parsing are done only once, and the spaCy document is reused.
+
+    The state that changes between the linkers (linkable and links) is taken from the spans at every call,
+    and overlaid on the entities of the document.
+    """
+
+    def __init__(self, pipeline, paragraph):
+        self.pipeline = pipeline
+        self.text = paragraph['text']
+        self.spans = paragraph['spans']
+        self.words, self.spaces, spans_remapped = pipeline.convert_to_spacy(paragraph['tokens'], paragraph['spans'])
+        self.offsets = [(span['token_start'], span['token_end']) for span in spans_remapped]
+        self.spacy_text = ''.join([self.words[i] + (' ' if self.spaces[i] else '') for i in range(0, len(self.words))])
+
+        self.doc = None
+        self.entity_tokens = {}
+
+    def overlay(self, spans):
+        """Return a copy of the spans with the token offsets remapped to the spaCy tokenisation"""
+        spans_remapped = []
+        for span, (token_start, token_end) in zip(spans, self.offsets):
+            span_remapped = SpacyPipeline.copy_span(span)
+            span_remapped['token_start'] = token_start
+            span_remapped['token_end'] = token_end
+            spans_remapped.append(span_remapped)
+
+        return spans_remapped
+
+    def get_doc(self, spans_remapped):
+        """Return the spaCy document, with linkable and links of the entities taken from the remapped spans"""
+        if self.doc is None:
+            self.set_doc(self.pipeline.init_doc(self.words, self.spaces, spans_remapped))
+
+        for span in spans_remapped:
+            token = self.entity_tokens.get(span['token_start'])
+            if token is None:
+                continue
+            token._.links = span['links'] if 'links' in span else []
+            token._.linkable = span['linkable'] if 'linkable' in span else False
+
+        return self.doc
+
+    def get_sentence(self):
+        """Return the (words, spaces, spans) used to build the spaCy document"""
+        return self.words, self.spaces, self.overlay(self.spans)
+
+    def set_doc(self, doc):
+        self.doc = doc
+        tokens_by_offset = {token.idx: token for token in doc}
+        word_offsets = []
+        offset = 0
+        for word, space in zip(self.words, self.spaces):
+            word_offsets.append(offset)
+            offset += len(word) + (1 if space else 0)
+
+        self.entity_tokens = {}
+        for token_start, _ in self.offsets:
+            if token_start < len(word_offsets) and word_offsets[token_start] in tokens_by_offset:
+                self.entity_tokens[token_start] = tokens_by_offset[word_offsets[token_start]]
+
+    @staticmethod
+    def parse(analyses, batch_size=None, n_process=1):
+        """Build in batches the spaCy documents of the analyses that have not been parsed yet"""
+        analyses = [analysis for analysis in analyses if analysis.doc is None]
+        if len(analyses) == 0:
+            return
+
+        docs = analyses[0].pipeline.init_docs([analysis.get_sentence() for analysis in analyses],
+                                              batch_size=batch_size, n_process=n_process)
+        for analysis, doc in zip(analyses, docs):
+            analysis.set_doc(doc)
+
+
 class RuleBasedLinker(SpacyPipeline):
-    def __init__(self, source="<tcValue>", destination="<material>", spacy_nlp=None):
+    def __init__(self, source="<tcValue>", destination="<material>", spacy_nlp=None,
+                 assignment=VicinityResolutionResolver.GREEDY_ASSIGNMENT):
         super(RuleBasedLinker, self).__init__(spacy_nlp)
         self.source = source
         self.destination = destination
+        self.resolver = VicinityResolutionResolver(assignment)
 
     MATERIAL_TC_TYPE = "<material-tcValue>"
     TC_PRESSURE_TYPE = "<tcValue-pressure>"
@@ -361,16 +498,46 @@ class RuleBasedLinker(SpacyPipeline):
         return output_data
 
     def process_paragraph(self, paragraph):
-        text_ = copy.deepcopy(paragraph['text'])
-        spans_ = copy.deepcopy(paragraph['spans'])
-        tokens_ = copy.deepcopy(paragraph['tokens'])
-
-        return self.process(text_, spans_, tokens_)
+        return self.process(paragraph['text'], paragraph['spans'], paragraph['tokens'])
 
     def process_paragraph_json(self, paragraph_json):
         paragraph = json.loads(paragraph_json)
         return json.dumps(self.process_paragraph(paragraph))
 
+    def process_paragraphs(self, paragraphs, batch_size=None, n_process=1):
+        """Same as process_paragraph() for a list of paragraphs, parsed in batches with nlp.pipe()"""
+        analyses = [ParagraphAnalysis(self, paragraph) for paragraph in paragraphs]
+        linkable_analyses = [analysis for analysis in analyses if self.is_linkable(analysis.overlay(analysis.spans))]
+        ParagraphAnalysis.parse(linkable_analyses, batch_size=batch_size, n_process=n_process)
+
+        return [self.process_analysis(analysis, paragraph['spans']) for analysis, paragraph in zip(analyses, paragraphs)]
+
+    def is_linkable(self, spans_remapped):
+        """True when the spans contain both source and destination entities"""
+        return any(span['type'] == self.destination for span in spans_remapped) and \
+            any(span['type'] == self.source for span in spans_remapped)
+
+    def process_analysis(self, analysis, spans_):
+        """Same as process(), reusing the spaCy document of a ParagraphAnalysis"""
+        spans_remapped = analysis.overlay(spans_)
+
+        output_data = []
+
+        if self.is_linkable(spans_remapped):
+            data_return = self.extract_links(analysis.get_doc(spans_remapped), analysis.spacy_text)
+
+            if len(data_return) > 0:
+                output_data.append(data_return)
+        else:
+            data_return = {
+                "spans": [entity for entity in
+                          filter(lambda w: w['type'] in entities_classes(), spans_remapped)],
+                "text": analysis.spacy_text
+            }
+            output_data.append(data_return)
+
+        return output_data
+
     def process_sentence(self, words, spaces, spans):
         text = ''.join([words[i] + (' ' if spaces[i] else '') for i in range(0, len(words))])
 
@@ -378,6 +545,9 @@ class RuleBasedLinker(SpacyPipeline):
 
         doc = self.init_doc(words, spaces, spans)
 
+        return self.extract_links(doc, text)
+
+    def extract_links(self, doc, text):
         extracted_entities = {}
         # svg = displacy.render(doc, style="dep")
         # filename = hashlib.sha224(b"Nobody inspects the spammish repetition").hexdigest()
@@ -403,8 +573,7 @@ class RuleBasedLinker(SpacyPipeline):
         else:
             ## 2 vicinity matching
 
-            resolver = VicinityResolutionResolver()
-            relationships = resolver.find_relationships(doc, destination_entities, source_entities)
+            relationships = self.resolver.find_relationships(doc, destination_entities, source_entities)
             if len(relationships) > 0:
                 extracted_entities['relationships'].extend(
                     RuleBasedLinker.collect_relationships(relationships, 'vicinity'))
@@ -430,8 +599,68 @@ class RuleBasedLinker(SpacyPipeline):
 
 
 class CriticalTemperatureClassifier(SpacyPipeline):
+    # This is case sensitive
+    NON_TC_EXPRESSIONS_BEFORE = ["T N", "TN", "t n", "tn", "Curie", "curie", "Neel", "neel", "at T ", "at T =",
+                                 "at T=",
+                                 "is suppressed at ", "ΔT c", "ΔTc", "Δ T c", "T =", "T=", "T = ", "T= "]
+    # This is case insensitive
+    TC_EXPRESSIONS_BEFORE = ["superconducts at", "superconductive at around",
+                             "superconducts around", "superconductivity at",
+                             "superconductivity around", "exibits superconductivity at",
+                             "T c =", "Tc ="]
+
+    # This is case insensitive
+    NON_TC_EXPRESSIONS_AFTER = ['higher', 'lower']
+
     def __init__(self, spacy_nlp=None):
         super(CriticalTemperatureClassifier, self).__init__(spacy_nlp)
+        self.non_tc_expressions_before = self.compile_expressions(self.NON_TC_EXPRESSIONS_BEFORE)
+        self.tc_expressions_before = self.compile_expressions(self.TC_EXPRESSIONS_BEFORE)
+        self.non_tc_expressions_after = set(self.NON_TC_EXPRESSIONS_AFTER)
+
+        # The fast classification gives the same result only when the parsing does not merge the noun phrases
+        self.fast_classification = not self.parsing_merges_phrases()
+        if not self.fast_classification:
+            print("The tagger and parser set the POS and the dependencies: the fast classification is disabled")
+
+    def parsing_merges_phrases(self):
+        """
+        True when init_doc() can merge the noun phrases of a document. The noun chunks require both the coarse POS
+        and the dependencies, and the tagger of en_core_web_sm sets only the fine-grained tags (the POS are set by
+        the attribute_ruler, which is not run): this is checked on a sample sentence.
+        """
+        if "tagger" not in self.nlp.pipe_names or "parser" not in self.nlp.pipe_names:
+            return False
+
+        doc = Doc(self.nlp.vocab, words=["The", "sample", "is", "superconducting", "below", "39", "K", "."],
+                  spaces=[True, True, True, True, True, True, False, False])
+        self.nlp.get_pipe("tagger")(doc)
+        self.nlp.get_pipe("parser")(doc)
+
+        return doc.has_annotation("POS") and doc.has_annotation("DEP")
+
+    @staticmethod
+    def compile_expressions(expressions):
+        """
+        Group the expressions by number of tokens (words separated by a space), so that the text of the tokens
+        preceding a position is built once per length and looked up among all the expressions of that length.
+        """
+        compiled = {}
+        for expression in expressions:
+            compiled.setdefault(len(expression.split(" ")), set()).add(expression)
+
+        return compiled
+
+    @staticmethod
+    def match_before(doc, doc_text, end, compiled_expressions, lowercase=False):
+        """True if the text of the tokens ending right before the token 'end' is one of the expressions"""
+        for length, expressions in compiled_expressions.items():
+            if end - length >= 0:
+                text = doc_text[doc[end - length].idx: doc[end - 1].idx + len(doc[end - 1])]
+                if (str.lower(text) if lowercase else text) in expressions:
+                    return True
+
+        return False
 
     def process_doc(self, doc):
         temps = list(filter(
@@ -443,23 +672,11 @@ class CriticalTemperatureClassifier(SpacyPipeline):
 
         tc_expressions = list(filter(lambda w: w.ent_type_ in ['<tc>', 'tc'], doc))
 
-        # This is case sensitive 
-        non_tc_expressions_before = ["T N", "TN", "t n", "tn", "Curie", "curie", "Neel", "neel", "at T ", "at T =",
-                                     "at T=",
-                                     "is suppressed at ", "ΔT c", "ΔTc", "Δ T c", "T =", "T=", "T = ", "T= "]
-        # This is case insensitive 
-        tc_expressions_before = ["superconducts at", "superconductive at around",
-                                 "superconducts around", "superconductivity at",
-                                 "superconductivity around", "exibits superconductivity at",
-                                 "T c =", "Tc ="]
-        
-        # This is case insensitive
-        non_tc_expressions_after = ['higher', 'lower']
-
         marked_as_tc = []
         marked_as_non_tc = []
 
-        if 'respectively' in str(doc):
+        doc_text = doc.text
+        if 'respectively' in doc_text:
             if len(tc_expressions) > 0:
                 respectively_tokens = [token for token in doc if str(token) == 'respectively']
                 if len(respectively_tokens) == 1:
@@ -471,6 +688,12 @@ class CriticalTemperatureClassifier(SpacyPipeline):
 
                     marked_as_tc.extend(temps_before_respectively)
         else:
+            # Number of tokens, up to each token, having the same text as one of the tc expressions of the document
+            tc_texts = set([tc.text for tc in tc_expressions])
+            tc_text_counts = [0]
+            for token in doc:
+                tc_text_counts.append(tc_text_counts[-1] + (1 if token.text in tc_texts else 0))
+
             for index_t, temp in enumerate(temps):
                 if temp in marked_as_tc:
                     continue
@@ -480,67 +703,44 @@ class CriticalTemperatureClassifier(SpacyPipeline):
                     continue
 
                 ## search for nonTC espressions after the temperature
-                for non_tc in non_tc_expressions_after:
-                    if temp.i + 1 < len(doc) and str.lower(doc[temp.i + 1].text) == non_tc:
-                        marked_as_non_tc.append(temp)
-                        break
-
-                if temp in marked_as_non_tc:
+                if temp.i + 1 < len(doc) and str.lower(doc[temp.i + 1].text) in self.non_tc_expressions_after:
+                    marked_as_non_tc.append(temp)
                     continue
 
-                for non_tc in non_tc_expressions_before:
-                    if temp.i - len(non_tc.split(" ")) >= 0 and doc[
-                                                               temp.i - len(non_tc.split(" ")):temp.i].text == non_tc:
-                        marked_as_non_tc.append(temp)
-                        break
-
-                if temp in marked_as_non_tc:
+                if self.match_before(doc, doc_text, temp.i, self.non_tc_expressions_before):
+                    marked_as_non_tc.append(temp)
                     continue
 
-                ## search for tc espressions just before the temperature
-
-                for tc in tc_expressions_before:
-                    if temp.i - len(tc.split(" ")) >= 0 and str.lower(doc[temp.i - len(tc.split(" ")):temp.i].text) == tc:
-                        marked_as_tc.append(temp)
-                        # temp.ent_type_ = "temperature-tc"
-                        break
-
-                    if temp.i - len(tc.split(" ")) - 1 >= 0 and str.lower(doc[
-                                                               temp.i - len(tc.split(" ")) - 1:temp.i - 1].text) == tc:
-                        marked_as_tc.append(temp)
-                        # temp.ent_type_ = "temperature-tc"
-                        break
-
-                if temp in marked_as_tc:
+                ## search for tc espressions just before the temperature, or before the previous token
+                if self.match_before(doc, doc_text, temp.i, self.tc_expressions_before, lowercase=True) or \
+                    self.match_before(doc, doc_text, temp.i - 1, self.tc_expressions_before, lowercase=True):
+                    marked_as_tc.append(temp)
                     continue
 
-                ## search for dynamic tc expressions
-
-                for tc in tc_expressions:
-                    # If it's found in the tc_expressions it was merged as a single expression
-                    expression_lenght = 1
-
-                    start = temp.i
-                    previous_temp_index = temps[index_t - 1].i if index_t > 0 else 0
-                    index = start - expression_lenght
-                    while index >= max(0, previous_temp_index):
-
-                        if doc[index: start].text == tc.text:
-                            marked_as_tc.append(temp)
-                            # temp.ent_type_ = "temperature-tc"
-                            break
-
-                        start -= 1
-                        index = start - expression_lenght
+                ## search for dynamic tc expressions: any token, from the previous temperature, with the same text
+                # of a tc expression
+                previous_temp_index = temps[index_t - 1].i if index_t > 0 else 0
+                start = max(0, previous_temp_index)
+                if start < temp.i and tc_text_counts[temp.i] - tc_text_counts[start] > 0:
+                    marked_as_tc.append(temp)
 
         for temp in marked_as_tc:
             temp._.set('linkable', True)
             # print(temp.text, temp.ent_type_)
         return doc
 
-    def mark_temperatures(self, text_, tokens_, spans_):
+    def mark_temperatures(self, text_, tokens_, spans_, fast=False):
+        """
+        Mark the temperatures that are Tc as linkable.
+        fast: the document is not tagged and parsed, which is not needed by the classification. The result is the
+            same as long as the parsing does not merge the noun phrases (see parsing_merges_phrases()), otherwise the
+            document is parsed anyway.
+        """
         words, spaces, spans_remapped = self.convert_to_spacy(tokens_, spans_)
-        doc = self.init_doc(words, spaces, spans_remapped)
+        if fast and self.fast_classification:
+            doc = self.init_doc_without_parsing(words, spaces, spans_remapped)
+        else:
+            doc = self.init_doc(words, spaces, spans_remapped)
         doc = self.process_doc(doc)
 
         extracted_entities = {}
@@ -553,12 +753,33 @@ class CriticalTemperatureClassifier(SpacyPipeline):
 
         return extracted_entities
 
-    def mark_temperatures_paragraph(self, paragraph):
-        text_ = copy.deepcopy(paragraph['text'])
-        spans_ = copy.deepcopy(paragraph['spans'])
-        tokens_ = copy.deepcopy(paragraph['tokens'])
+    def mark_temperatures_paragraph(self, paragraph, fast=False):
+        return self.mark_temperatures(paragraph['text'], paragraph['tokens'], paragraph['spans'], fast=fast)
+
+    def mark_temperatures_analysis(self, analysis, spans_):
+        """Same as mark_temperatures(), reusing the spaCy document of a ParagraphAnalysis"""
+        doc = self.process_doc(analysis.get_doc(analysis.overlay(spans_)))
+
+        extracted_entities = {}
+
+        converted_spans = [span_to_dict(entity) for entity in
+                           filter(lambda w: w.ent_type_ in entities_classes(), doc)]
+
+        extracted_entities['spans'] = converted_spans
+        extracted_entities['text'] = analysis.text
+
+        return extracted_entities
+
+    def mark_temperatures_paragraphs(self, paragraphs, batch_size=None, n_process=1, fast=False):
+        """Same as mark_temperatures_paragraph() for a list of paragraphs, parsed in batches with nlp.pipe()"""
+        if fast and self.fast_classification:
+            return [self.mark_temperatures_paragraph(paragraph, fast=True) for paragraph in paragraphs]
+
+        analyses = [ParagraphAnalysis(self, paragraph) for paragraph in paragraphs]
+        ParagraphAnalysis.parse(analyses, batch_size=batch_size, n_process=n_process)
 
-        return self.mark_temperatures(text_, tokens_, spans_)
+        return [self.mark_temperatures_analysis(analysis, paragraph['spans']) for analysis, paragraph in
+                zip(analyses, paragraphs)]
 
     def mark_temperatures_paragraph_json(self, paragraph_json):
         paragraph = json.loads(paragraph_json)
@@ -1,5 +1,9 @@
+from bisect import bisect_left, bisect_right
 from operator import itemgetter
 
+import numpy
+from scipy.optimize import linear_sum_assignment
+
 
 class ResolutionResolver(object):
     def link_spans(self, entity1, entity2, linkingType):
@@ -47,6 +51,19 @@ class VicinityResolutionResolver(ResolutionResolver):
 
     # TODO: add multi tokens, should modify the way tokens are looked up first...
 
+    GREEDY_ASSIGNMENT = "greedy"
+    OPTIMAL_ASSIGNMENT = "optimal"
+
+    def __init__(self, assignment=GREEDY_ASSIGNMENT):
+        """
+        assignment: how the materials and the tcs are coupled by distance, when there are several of both.
+            - greedy: each material (or each tc, if they are fewer) takes the closest entity not yet assigned
+            - optimal: the couples minimising the sum of the distances (linear sum assignment)
+        """
+        if assignment not in [self.GREEDY_ASSIGNMENT, self.OPTIMAL_ASSIGNMENT]:
+            raise ValueError("Invalid assignment strategy: " + str(assignment))
+        self.assignment = assignment
+
     ## Assume the entities are already sorted
     def find_relationships(self, doc, destination_entities, source_entities):
         relationships = []
@@ -90,8 +107,11 @@ class VicinityResolutionResolver(ResolutionResolver):
                         relationships.extend(self.assign_in_order(entities1_reduced, entities2_reduced))
                         previous_index = respectively_token.i
 
+            elif self.assignment == self.OPTIMAL_ASSIGNMENT:
+                relationships.extend(self.assign_optimal(destination_entities, source_entities, doc))
+
             else:
-                assigned = []
+                assigned = set()
                 # for each material I find the closest temperature who has not been assigned yet
                 material_tc_mapping = self.calculate_distances(destination_entities, source_entities, doc)
 
@@ -116,8 +136,8 @@ class VicinityResolutionResolver(ResolutionResolver):
                         tc = min(tc_of_this_material, key=tc_of_this_material.get)
                         if material not in assigned and tc not in assigned:
                             relationships.append(self.link_spans(material, tc, 'distance'))
-                            assigned.append(material)
-                            assigned.append(tc)
+                            assigned.add(material)
+                            assigned.add(tc)
                 else:
                     for tc in tc_material_mapping.keys():
                         material_of_this_tc = {material_: distance for material_, distance in
@@ -125,11 +145,22 @@ class VicinityResolutionResolver(ResolutionResolver):
                         material = min(material_of_this_tc, key=material_of_this_tc.get)
                         if material not in assigned and tc not in assigned:
                             relationships.append(self.link_spans(material, tc, 'distance'))
-                            assigned.append(material)
-                            assigned.append(tc)
+                            assigned.add(material)
+                            assigned.add(tc)
 
         return relationships
 
+    def assign_optimal(self, materials, tc_values, doc):
+        """Link the couples of material / tc minimising the sum of their distances"""
+        distances = self.calculate_distance_matrix(materials, tc_values, doc)
+        material_indexes, tc_indexes = linear_sum_assignment(distances)
+
+        couples = sorted(zip(material_indexes.tolist(), tc_indexes.tolist()),
+                         key=itemgetter(0 if len(materials) <= len(tc_values) else 1))
+
+        return [self.link_spans(materials[material_index], tc_values[tc_index], 'distance') for
+                material_index, tc_index in couples]
+
     def assign_in_order(self, entities1, entities2):
         relationships = []
         ## for each material I assign each material to each Tcs, in order of appearance
@@ -229,69 +260,163 @@ class VicinityResolutionResolver(ResolutionResolver):
             - duplicate the distance if a punctuation item is between a couple of material / tc
         '''
         material_tc_mapping = {}
-        OPENING_PARENTHESIS = ["(", "[", "{"]
-        CLOSING_PARENTHESIS = [")", "]", "}"]
-        for index, material in enumerate(materials):
-            pivot_centroid = material.idx + (len(material) / 2)
+        if len(materials) == 0 or len(tc_values) == 0:
+            return material_tc_mapping
 
-            # If the Tc is present within a parenthesis, I expand the entity to the whole parenthesis itself.
-            tc_distances = {}
+        distances = self.calculate_distance_matrix(materials, tc_values, doc)
 
-            for tc_value in tc_values:
-                previous_material = self.find_previous_entity(tc_value, materials)
-                following_material = self.find_following_entity(tc_value, materials)
+        for material, material_distances in zip(materials, distances.tolist()):
+            material_tc_mapping[material] = dict(zip(tc_values, material_distances))
 
-                if previous_material is None:
-                    previous_material_index = -1
-                else:
-                    previous_material_index = previous_material.i
-
-                if following_material is None:
-                    following_material_index = len(doc)
-                else:
-                    following_material_index = following_material.i
-
-                # Find out if the opened parenthesis appearing between this tc and the previous material matches
-                # the closed parenthesis appearing between this tc and the next material
-                any_opened_parenthesis = [item for item in OPENING_PARENTHESIS if
-                                          item in str(doc[previous_material_index + 1: tc_value.i])]
-                any_closed_parenthesis = [item for item in CLOSING_PARENTHESIS if
-                                          item in str(doc[tc_value.i + 1:following_material_index])]
-
-                couple_of_parenthesis = [opened for opened in any_opened_parenthesis if CLOSING_PARENTHESIS[
-                    OPENING_PARENTHESIS.index(opened)] in any_closed_parenthesis]
-
-                if len(couple_of_parenthesis) > 0:
-                    # doc[previous_material.i + 1: following_material.i - 1].merge()
-
-                    starting_token = [token for token in doc[previous_material_index + 1: tc_value.i] if
-                                      str(token) in OPENING_PARENTHESIS][0]
-                    ending_token = [token for token in doc[tc_value.i + 1:following_material_index] if
-                                    str(token) in CLOSING_PARENTHESIS][-1]
-
-                    tc_distances[tc_value] = abs(pivot_centroid - starting_token.idx +
-                                                 len(str(doc[starting_token.i: ending_token.i])) / 2)
-
-                    # Extracting the chunk of text between the material and the updated tcvalue
-                    if material.i < tc_value.i:
-                        chunk = str(doc[material.i + 1: starting_token.i]) if material.i + 1 < starting_token.i else ""
-                    else:
-                        chunk = str(doc[ending_token.i + 1: material.i]) if ending_token.i + 1 < material.i else ""
-                else:
-                    tc_distances[tc_value] = abs(pivot_centroid - (tc_value.idx + len(tc_value) / 2))
-                    if material.i < tc_value.i:
-                        chunk = str(doc[material.i + 1: tc_value.i]) if material.i + 1 < tc_value.i else ""
-                    else:
-                        chunk = str(doc[tc_value.i + 1: material.i]) if tc_value.i + 1 < material.i else ""
-
-                # Adding penalties in the distances, when the chunk of text in between, contains
-                # commas or other punctuation
-                if any(item in chunk for item in self.separators):
-                    tc_distances[tc_value] *= 2
+        return material_tc_mapping
 
-                material_tc_mapping[material] = tc_distances
+    def calculate_distance_matrix(self, materials, tc_values, doc):
+        """Same as calculate_distances(), as an array materials x tc_values"""
+        index = DocumentIndex(doc, self.separators)
+
+        sorted_materials = sorted(materials, key=lambda material: material.idx)
+        material_offsets = [material.idx for material in sorted_materials]
+
+        # For each tc: the position used to calculate the distance (start, half length) and the tokens delimiting
+        # the text between the tc and a material before (left) or after it (right)
+        tc_starts = []
+        tc_half_lengths = []
+        left_boundaries = []
+        right_boundaries = []
+        for tc_value in tc_values:
+            previous_material = bisect_left(material_offsets, tc_value.idx)
+            previous_material_index = sorted_materials[previous_material - 1].i if previous_material > 0 else -1
+            following_material = bisect_right(material_offsets, tc_value.idx)
+            following_material_index = sorted_materials[following_material].i \
+                if following_material < len(sorted_materials) else len(doc)
 
-        return material_tc_mapping
+            # If the Tc is present within a parenthesis, I expand the entity to the whole parenthesis itself.
+            starting_token, ending_token = index.find_wrapping_parenthesis(previous_material_index, tc_value.i,
+                                                                           following_material_index)
+            if starting_token is not None:
+                tc_starts.append(index.token_starts[starting_token])
+                tc_half_lengths.append((index.token_ends[ending_token - 1] - index.token_starts[starting_token]) / 2)
+                left_boundaries.append(starting_token)
+                right_boundaries.append(ending_token)
+            else:
+                tc_starts.append(tc_value.idx + len(tc_value) / 2)
+                tc_half_lengths.append(0)
+                left_boundaries.append(tc_value.i)
+                right_boundaries.append(tc_value.i)
+
+        pivot_centroids = numpy.array([material.idx + (len(material) / 2) for material in materials])[:, None]
+        distances = numpy.abs(pivot_centroids - numpy.array(tc_starts)[None, :] + numpy.array(tc_half_lengths)[None, :])
+
+        # Extracting the chunk of text (token range) between the material and the updated tcvalue
+        material_indexes = numpy.array([material.i for material in materials])[:, None]
+        tc_indexes = numpy.array([tc_value.i for tc_value in tc_values])[None, :]
+        material_before = material_indexes < tc_indexes
+        chunk_starts = numpy.where(material_before, material_indexes + 1, numpy.array(right_boundaries)[None, :] + 1)
+        chunk_ends = numpy.where(material_before, numpy.array(left_boundaries)[None, :], material_indexes)
+
+        # Adding penalties in the distances, when the chunk of text in between, contains
+        # commas or other punctuation
+        return numpy.where(index.contains_separator(chunk_starts, chunk_ends), distances * 2, distances)
+
+
+class DocumentIndex:
+    """
+    Positions calculated once per document, to avoid slicing the document for each couple of material / tc:
+    token offsets, occurrences of the separators and of the parenthesis in the text, and the closest
+    parenthesis token to each token.
+    """
+    OPENING_PARENTHESIS = ["(", "[", "{"]
+    CLOSING_PARENTHESIS = [")", "]", "}"]
+
+    def __init__(self, doc, separators):
+        self.length = len(doc)
+        self.token_starts = numpy.array([token.idx for token in doc], dtype=int)
+        self.token_ends = numpy.array([token.idx + len(token) for token in doc], dtype=int)
+
+        self.separators = {separator: self.find_occurrences(doc.text, separator) for separator in separators}
+        self.parenthesis = {parenthesis: self.find_occurrences(doc.text, parenthesis) for parenthesis in
+                            self.OPENING_PARENTHESIS + self.CLOSING_PARENTHESIS}
+
+        # Index of the first opening parenthesis token from each token, and of the last closing one up to each token
+        self.next_opening = [self.length] * (self.length + 1)
+        for token in reversed(doc):
+            self.next_opening[token.i] = token.i if str(token) in self.OPENING_PARENTHESIS else self.next_opening[
+                token.i + 1]
+        self.previous_closing = [-1] * self.length
+        for token in doc:
+            if str(token) in self.CLOSING_PARENTHESIS:
+                self.previous_closing[token.i] = token.i
+            elif token.i > 0:
+                self.previous_closing[token.i] = self.previous_closing[token.i - 1]
+
+    @staticmethod
+    def find_occurrences(text, substring):
+        occurrences = []
+        position = text.find(substring)
+        while position > -1:
+            occurrences.append(position)
+            position = text.find(substring, position + 1)
+
+        return numpy.array(occurrences, dtype=int)
+
+    def text_offsets(self, start, end):
+        """Character offsets of the text of the tokens [start, end), (0, 0) when empty"""
+        if start >= end:
+            return 0, 0
+        return self.token_starts[start], self.token_ends[end - 1]
+
+    def contains(self, occurrences, length, start, end):
+        """True if any of the occurrences of a substring lays within the text of the tokens [start, end)"""
+        offset_start, offset_end = self.text_offsets(start, end)
+        first = bisect_left(occurrences, offset_start)
+        return first < len(occurrences) and occurrences[first] + length <= offset_end
+
+    def find_wrapping_parenthesis(self, previous_material_index, tc_index, following_material_index):
+        """
+        Find the parenthesis tokens wrapping the tc, between the previous material and the following one, when
+        an opened parenthesis before the tc matches a closed one after it. Returns (None, None) otherwise.
+        """
+        any_opened_parenthesis = [item for item in self.OPENING_PARENTHESIS if
+                                  self.contains(self.parenthesis[item], 1, previous_material_index + 1, tc_index)]
+        any_closed_parenthesis = [item for item in self.CLOSING_PARENTHESIS if
+                                  self.contains(self.parenthesis[item], 1, tc_index + 1, following_material_index)]
+
+        couple_of_parenthesis = [opened for opened in any_opened_parenthesis if self.CLOSING_PARENTHESIS[
+            self.OPENING_PARENTHESIS.index(opened)] in any_closed_parenthesis]
+
+        if len(couple_of_parenthesis) == 0:
+            return None, None
+
+        starting_token = self.next_opening[previous_material_index + 1]
+        ending_token = self.previous_closing[following_material_index - 1]
+
+        # The parenthesis could be only part of a token, e.g. "(Tc"
+        if starting_token >= tc_index or ending_token <= tc_index:
+            return None, None
+
+        return starting_token, ending_token
+
+    def contains_separator(self, chunk_starts, chunk_ends):
+        """
+        For each token range [chunk_starts, chunk_ends) (arrays of the same shape), True if the text contains
+        any of the separators
+        """
+        non_empty = chunk_starts < chunk_ends
+        if self.length == 0:
+            return non_empty
+
+        offset_starts = self.token_starts[numpy.clip(chunk_starts, 0, self.length - 1)]
+        offset_ends = self.token_ends[numpy.clip(chunk_ends - 1, 0, self.length - 1)]
+
+        contains = numpy.zeros(chunk_starts.shape, dtype=bool)
+        for separator, occurrences in self.separators.items():
+            if len(occurrences) == 0:
+                continue
+            first = numpy.searchsorted(occurrences, offset_starts, side='left')
+            last = numpy.searchsorted(occurrences, offset_ends - len(separator), side='right')
+            contains |= last > first
+
+        return contains & non_empty
 
 
 class DependencyParserResolutionResolver(ResolutionResolver):
@@ -1,11 +1,202 @@
 import re
 
-from pymatgen.core import Composition
+import numpy as np
+
+from material_parsers.commons.result_cache import Memoizer
+
 ## This map define the rules for selecting the classes.
 # and_compunds is satisfied if ALL of the contained compounds are present
 # or_compounds is satisfied if ANY of the contained compound is present
 from sympy import SympifyError
 
+ELEMENTS = [
+    "H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg", "Al", "Si", "P", "S", "Cl", "Ar", "K", "Ca",
+    "Sc", "Ti", "V", "Cr", "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Ga", "Ge", "As", "Se", "Br", "Kr", "Rb", "Sr", "Y",
+    "Zr", "Nb", "Mo", "Tc", "Ru", "Rh", "Pd", "Ag", "Cd", "In", "Sn", "Sb", "Te", "I", "Xe", "Cs", "Ba", "La", "Ce",
+    "Pr", "Nd", "Pm", "Sm", "Eu", "Gd", "Tb", "Dy", "Ho", "Er", "Tm", "Yb", "Lu", "Hf", "Ta", "W", "Re", "Os", "Ir",
+    "Pt", "Au", "Hg", "Tl", "Pb", "Bi", "Po", "At", "Rn", "Fr", "Ra", "Ac", "Th", "Pa", "U", "Np", "Pu", "Am", "Cm",
+    "Bk", "Cf", "Es", "Fm", "Md", "No", "Lr", "Rf", "Db", "Sg", "Bh", "Hs", "Mt", "Ds", "Rg", "Cn", "Nh", "Fl", "Mc",
+    "Lv", "Ts", "Og"
+]
+
+ELEMENTS_SET = set(ELEMENTS)
+
+# The separators of the hydrates (e.g. CuSO4·5H2O)
+HYDRATE_SEPARATORS = "·•∙⋅"
+
+# Amounts below this value are not part of the composition, as in pymatgen
+AMOUNT_TOLERANCE = 1e-8
+
+PATTERN_NUMBER = re.compile(r"[0-9]+\.?[0-9]*|\.[0-9]+")
+PATTERN_SYMBOL = re.compile(r"[A-Z][a-z]*")
+PATTERN_HYDRATE_COEFFICIENT = re.compile(r"[0-9]+\.?[0-9]*|\.[0-9]+|[a-z](?=[A-Z(])")
+
+
+class AmbiguousFormula(Exception):
+    """The formula cannot be decomposed by extract_elements(). """
+    pass
+
+
+def extract_elements(formula):
+    """
+    Return the elements of a formula, in order of appearance, without parsing the amounts into a composition.
+
+    The formula is made of element symbols with numeric amounts, groups in parentheses followed by a factor, hydrates
+    (CuSO4·5H2O, the coefficient can be a variable: NaCoO2·yH2O) and alternative elements separated by commas
+    in parentheses ((La,Sr)2CuO4). The elements with zero amount are dropped.
+    Return None when the formula contains anything else (e.g. variables in the amounts, unknown symbols, a hydrate
+    without the main formula).
+    """
+    amounts = {}
+    try:
+        for index, part in enumerate(re.split("[" + HYDRATE_SEPARATORS + "]", formula.replace("@", ""))):
+            factor = 1.0
+            position = skip_spaces(part, 0)
+            # A hydrate separator at the start or at the end (e.g. ·5H2O) is left to pymatgen
+            if position == len(part):
+                return None
+            if index > 0:
+                match = PATTERN_HYDRATE_COEFFICIENT.match(part, position)
+                if match:
+                    factor = float(match.group()) if not match.group().isalpha() else 1.0
+                    position = match.end()
+
+            position = parse_sequence(part, position, factor, amounts)
+            if position != len(part):
+                return None
+    except AmbiguousFormula:
+        return None
+
+    return [element for element, amount in amounts.items() if abs(amount) >= AMOUNT_TOLERANCE]
+
+
+def skip_spaces(formula, position):
+    while position < len(formula) and formula[position].isspace():
+        position += 1
+    return position
+
+
+def parse_number(formula, position):
+    """Return the number at position (or None) and the position after it. A number must not be followed by
+    another part of an expression (e.g. 1-x, 2e3). """
+    match = PATTERN_NUMBER.match(formula, position)
+    if not match:
+        return None, position
+    if match.end() < len(formula) and (formula[match.end()] in "-+*e" or formula[match.end()].islower()):
+        raise AmbiguousFormula()
+    return float(match.group()), match.end()
+
+
+def parse_sequence(formula, position, factor, amounts):
+    """Parse the elements and groups from position, until the end, a comma or a closing parenthesis. """
+    position = skip_spaces(formula, position)
+    while position < len(formula) and formula[position] not in ",)":
+        if formula[position] == "(":
+            group_amounts = {}
+            position = parse_sequence(formula, position + 1, 1.0, group_amounts)
+            while position < len(formula) and formula[position] == ",":
+                position = parse_sequence(formula, position + 1, 1.0, group_amounts)
+            if position == len(formula) or not group_amounts:
+                raise AmbiguousFormula()
+
+            group_factor, position = parse_number(formula, skip_spaces(formula, position + 1))
+            for element, amount in group_amounts.items():
+                amounts[element] = amounts.get(element, 0.0) + amount * (group_factor if group_factor is not None
+                                                                        else 1.0) * factor
+        else:
+            match = PATTERN_SYMBOL.match(formula, position)
+            if not match or match.group() not in ELEMENTS_SET:
+                raise AmbiguousFormula()
+
+            amount, position = parse_number(formula, skip_spaces(formula, match.end()))
+            amounts[match.group()] = amounts.get(match.group(), 0.0) + (amount if amount is not None else 1.0) * factor
+
+        position = skip_spaces(formula, position)
+
+    return position
+
+
+# Bit of each element in the masks, the rule sets add the other symbols found in their rules (e.g. "Nd,")
+ELEMENT_BITS = {symbol: bit for bit, symbol in enumerate(ELEMENTS)}
+
+
+class RuleSet:
+    """
+    The rules of a composition map (and_compounds, or_compounds, not_compounds) compiled into masks of symbols,
+    so that each rule is tested with a single operation on the mask of the elements of a formula.
+
+    The kind of a rule is given by the first non-empty list among and, or and not (when negations is set).
+    The symbols that are not strings (e.g. {"S": 2}) are ignored when ignore_non_symbols is set, otherwise they are
+    never present, and the "and" rules containing them never match.
+    """
+    AND = "and"
+    OR = "or"
+    NOT = "not"
+
+    def __init__(self, composition_map, ignore_non_symbols=True, negations=True):
+        kinds = [self.AND, self.OR, self.NOT] if negations else [self.AND, self.OR]
+        # The bits are assigned per rule set, the masks must be built with to_mask() of the same rule set
+        self.symbol_bits = dict(ELEMENT_BITS)
+        self.names = []
+        self.rules = []
+        for composition in composition_map:
+            kind = next((kind for kind in kinds if len(composition.get(kind + "_compounds", [])) > 0), None)
+            compounds = composition.get(kind + "_compounds", []) if kind else []
+            symbols = [compound for compound in compounds if type(compound) == str]
+            never = kind is None or (kind == self.AND and not ignore_non_symbols and len(symbols) < len(compounds))
+
+            self.names.append(composition['name'])
+            self.rules.append((kind, never, sum(1 << self.get_symbol_bit(symbol) for symbol in set(symbols)),
+                               [self.get_symbol_bit(symbol) for symbol in symbols]))
+
+    def get_symbol_bit(self, symbol):
+        return self.symbol_bits.setdefault(symbol, len(self.symbol_bits))
+
+    def to_mask(self, symbols):
+        """Return the mask of the symbols (e.g. the elements of a formula), the unknown symbols are ignored. """
+        mask = 0
+        for symbol in symbols:
+            bit = self.symbol_bits.get(symbol)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def to_presence_matrix(self, symbol_lists):
+        """Return the boolean matrix (number of lists x number of symbols) of the symbols of each list. """
+        matrix = np.zeros((len(symbol_lists), len(self.symbol_bits)), dtype=bool)
+        for row, symbols in enumerate(symbol_lists):
+            bits = [self.symbol_bits[symbol] for symbol in symbols if symbol in self.symbol_bits]
+            matrix[row, bits] = True
+        return matrix
+
+    def matches(self, mask):
+        """Return for each rule whether the mask satisfies it. """
+        results = []
+        for kind, never, rule_mask, _ in self.rules:
+            if never:
+                results.append(False)
+            elif kind == self.AND:
+                results.append(mask & rule_mask == rule_mask)
+            elif kind == self.OR:
+                results.append(mask & rule_mask != 0)
+            else:
+                results.append(mask & rule_mask == 0)
+        return results
+
+    def matches_batch(self, matrix):
+        """Return the boolean matrix (rows of matrix x rules) of the rules satisfied by each row. """
+        results = np.zeros((matrix.shape[0], len(self.rules)), dtype=bool)
+        for index, (kind, never, _, bits) in enumerate(self.rules):
+            if never:
+                continue
+            elif kind == self.AND:
+                results[:, index] = matrix[:, bits].all(axis=1)
+            elif kind == self.OR:
+                results[:, index] = matrix[:, bits].any(axis=1)
+            else:
+                results[:, index] = ~matrix[:, bits].any(axis=1)
+        return results
+
 
 class ClassResolver:
     """
@@ -15,16 +206,48 @@ class ClassResolver:
 
     verbose = False
 
-    def __init__(self, materialParser=None, verbose=False):
+    def __init__(self, materialParser=None, verbose=False, cache_size=10000):
+        """
+            - cache_size: size of the LRU cache of the decomposed formulas, 0 disables it
+        """
         self.mp = materialParser
         self.verbose = verbose
 
+        # Number of formulas decomposed by each path
+        self.counters = {"fast": 0, "pymatgen": 0, "rewritten": 0, "material_parser": 0, "failed": 0}
+
+        self.cache = Memoizer(self.decompose_formula_uncached, max_size=cache_size,
+                              negative_max_size=0) if cache_size > 0 else None
+
+    def stats(self):
+        return {
+            "paths": dict(self.counters),
+            "cache": self.cache.stats() if self.cache else None
+        }
+
     def decompose_formula(self, formula):
+        if self.cache is not None:
+            return self.cache(formula)
+
+        return self.decompose_formula_uncached(formula)
+
+    def decompose_formula_uncached(self, formula):
+        elements = extract_elements(formula)
+        if elements is not None:
+            self.counters["fast"] += 1
+            return elements
+
+        return self.decompose_formula_pymatgen(formula)
+
+    def decompose_formula_pymatgen(self, formula):
+        # Imported here, as importing pymatgen is slow and the fast path is enough for most formulas
+        from pymatgen.core import Composition
 
         decomposed_formula = []
 
         try:
             dc = Composition(formula, strict=False).as_dict().keys()
+            self.counters["pymatgen"] += 1
         except Exception as ce:
             if self.verbose:
                 print("Exception when parsing " + str(formula) + ". Error: " + str(ce))
@@ -34,10 +257,12 @@ class ClassResolver:
                 if self.verbose:
                     print("Trying to parse " + str(material_formula_with_replacements))
                 dc = Composition(material_formula_with_replacements, strict=False).as_dict().keys()
+                self.counters["rewritten"] += 1
             except Exception as ce:
                 if self.verbose:
                     print("Exception when parsing " + str(material_formula_with_replacements) + ". Error: " + str(ce))
                 if self.mp is None:
+                    self.counters["failed"] += 1
                     return decomposed_formula
 
                 try:
@@ -46,24 +271,36 @@ class ClassResolver:
                     compounds = self.mp.formula2composition(material_formula_with_replacements)
                     if compounds is not None and 'elements' in compounds:
                         dc = compounds['elements'].keys()
+                        self.counters["material_parser"] += 1
                     else:
+                        self.counters["failed"] += 1
                         return decomposed_formula
 
                 except Exception as ee:
                     # We give up... skipping this record
                     if self.verbose:
                         print("Exception when parsing ", material_formula_with_replacements, ". Error: ", ee)
+                    self.counters["failed"] += 1
                     return decomposed_formula
                 except SympifyError as eee:
                     # We give up... skipping this record
                     if self.verbose:
                         print("Exception when parsing ", material_formula_with_replacements, ". Error: ", eee)
+                    self.counters["failed"] += 1
                     return decomposed_formula
 
         # print(" Input Formula: " + str())
         decomposed_formula = list(dc)
         return decomposed_formula
 
+    def decompose_all(self, compositions):
+        """
+        Return the symbols of each composition: a formula (decomposed), or the elements (e.g. the keys of a
+        formulaComposition).
+        """
+        return [self.decompose_formula(composition) if type(composition) == str else list(composition)
+                for composition in compositions]
+
 
 class Material2Class(ClassResolver):
     composition_map = [
@@ -87,37 +324,29 @@ class Material2Class(ClassResolver):
 
     verbose = False
 
-    def get_class(self, formula):
-        output = ''
+    def __init__(self, materialParser=None, verbose=False, cache_size=10000):
+        super().__init__(materialParser, verbose, cache_size)
+        self.rules = RuleSet(self.composition_map, ignore_non_symbols=False, negations=False)
 
+    def get_class(self, formula):
         input_formula = self.decompose_formula(formula)
 
         # print(" Input Formula: " + str(input_formula))
 
-        for composition in self.composition_map:
-            and_compounds = []
-            if 'and_compounds' in composition:
-                and_compounds = composition['and_compounds']
-
-            or_compounds = []
-            if 'or_compounds' in composition:
-                or_compounds = composition['or_compounds']
+        return self.first_class(self.rules.matches(self.rules.to_mask(input_formula)))
 
-            output_class = composition['name']
+    def get_class_batch(self, compositions):
+        """
+        Return the class of each composition (a formula or its elements), testing the rules on all the
+        compositions at once.
+        """
+        matches = self.rules.matches_batch(self.rules.to_presence_matrix(self.decompose_all(compositions)))
+        first_matches = np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
 
-            if len(and_compounds) > 0:
-                if all(elem in input_formula for elem in and_compounds):
-                    output = output_class
-                    break
-            elif len(or_compounds) > 0:
-                if any(elem in input_formula for elem in or_compounds):
-                    output = output_class
-                    break
+        return [self.rules.names[index] if index >= 0 else "Alloy" for index in first_matches]
 
-        if output == '':
-            output = "Alloy"
-
-        return output
+    def first_class(self, matches):
+        return next((name for name, match in zip(self.rules.names, matches) if match), "Alloy")
 
 
 class Material2Tags(ClassResolver):
@@ -180,79 +409,65 @@ class Material2Tags(ClassResolver):
 
     }
 
+    def __init__(self, materialParser=None, verbose=False, cache_size=10000):
+        super().__init__(materialParser, verbose, cache_size)
+        self.first_level_rules = RuleSet(self.material2class_first_level)
+        self.second_level_rules = {tag: RuleSet(composition_map) for tag, composition_map in
+                                   self.material2class_second_level.items()}
+
+        # The rules compiled for the composition maps of the class, by identity
+        self.compiled_rules = {id(self.material2class_first_level): self.first_level_rules}
+        for tag, composition_map in self.material2class_second_level.items():
+            self.compiled_rules[id(composition_map)] = self.second_level_rules[tag]
+
     def assign_tags(self, formula, composition_map):
-        output_tags = []
+        if type(composition_map) != list:
+            return set()
 
-        input_formula = self.decompose_formula(formula)
+        rules = self.compiled_rules.get(id(composition_map))
+        if rules is None:
+            rules = RuleSet(composition_map)
+
+        return self.match_tags(rules, self.decompose_formula(formula))
+
+    @staticmethod
+    def tags(rules, matches):
+        return set(name for name, match in zip(rules.names, matches) if match)
 
-        if type(composition_map) == list:
-            for composition in composition_map:
-                and_compounds = []
-                if 'and_compounds' in composition:
-                    and_compounds = composition['and_compounds']
-
-                or_compounds = []
-                if 'or_compounds' in composition:
-                    or_compounds = composition['or_compounds']
-
-                not_compounds = []
-                if 'not_compounds' in composition:
-                    not_compounds = composition['not_compounds']
-
-                output_class = composition['name']
-
-                if len(and_compounds) > 0:
-                    if all(elem in input_formula for elem in and_compounds if type(elem) == str):
-                        output_tags.append(output_class)
-                        continue
-                elif len(or_compounds) > 0:
-                    if any(elem in input_formula for elem in or_compounds if type(elem) == str):
-                        output_tags.append(output_class)
-                        continue
-                elif len(not_compounds) > 0:
-                    if not any(elem in input_formula for elem in not_compounds if type(elem) == str):
-                        output_tags.append(output_class)
-                        continue
-
-        elif type(composition_map) == map:
-            for first_element, composition in composition_map.items():
-                and_compounds = []
-                if 'and_compounds' in composition:
-                    and_compounds = composition['and_compounds']
-
-                or_compounds = []
-                if 'or_compounds' in composition:
-                    or_compounds = composition['or_compounds']
-
-                not_compounds = []
-                if 'not_compounds' in composition:
-                    not_compounds = composition['not_compounds']
-
-                output_class = composition_map[first_element]['name']
-
-                if len(and_compounds) > 0:
-                    if all(elem in input_formula for elem in and_compounds if type(elem) == str):
-                        output_tags.append(output_class)
-                        continue
-                elif len(or_compounds) > 0:
-                    if any(elem in input_formula for elem in or_compounds if type(elem) == str):
-                        output_tags.append(output_class)
-                        continue
-                elif len(not_compounds) > 0:
-                    if not any(elem in input_formula for elem in not_compounds if type(elem) == str):
-                        output_tags.append(output_class)
-                        continue
-        return set(output_tags)
+    def match_tags(self, rules, elements):
+        return self.tags(rules, rules.matches(rules.to_mask(elements)))
 
     def get_classes(self, formula):
-        tags = self.assign_tags(formula, composition_map=self.material2class_first_level)
+        # The formula is decomposed once for both levels
+        elements = self.decompose_formula(formula)
+
+        tags = self.match_tags(self.first_level_rules, elements)
 
         output = {tag: [] for tag in tags}
 
         for tag in tags:
-            if tag in self.material2class_second_level:
-                output[tag] = list(self.assign_tags(formula, composition_map=self.material2class_second_level[tag]))
+            if tag in self.second_level_rules:
+                output[tag] = list(self.match_tags(self.second_level_rules[tag], elements))
             else:
                 output[tag] = []
 
         return output
+
+    def get_classes_batch(self, compositions):
+        """
+        Return the classes of each composition (a formula or its elements) as get_classes(), testing the rules of
+        each level on all the compositions at once.
+        """
+        elements = self.decompose_all(compositions)
+
+        first_level_matches = self.first_level_rules.matches_batch(self.first_level_rules.to_presence_matrix(elements))
+        second_level_matches = {tag: rules.matches_batch(rules.to_presence_matrix(elements))
+                                for tag, rules in self.second_level_rules.items()}
+
+        outputs = []
+        for row, matches in enumerate(first_level_matches):
+            tags = self.tags(self.first_level_rules, matches)
+            outputs.append({tag: list(self.tags(self.second_level_rules[tag], second_level_matches[tag][row]))
+                            if tag in self.second_level_rules else [] for tag in tags})
+
+        return outputs
@@ -1,5 +1,11 @@
+import atexit
+import multiprocessing
+import queue
+from functools import partial
+
 from sympy import SympifyError
 
+from material_parsers.commons.result_cache import Memoizer
 from material_parsers.commons.utils import replace_with_closest, ALLOWED_CHARS_MATERIAL_PARSER
 from text2chem.parser_pipeline import ParserPipelineBuilder
 from text2chem.postprocessing_tools.substitute_additives import SubstituteAdditives
@@ -12,8 +18,118 @@ from text2chem.regex_parser import RegExParser
 from material_parsers.material_parser.material2class import Material2Class, Material2Tags
 
 
+class FormulaParsingError(Exception):
+    """The parsing process failed (e.g. it crashed or was killed), the input might be parsed at another attempt. """
+    pass
+
+
+class FormulaParsingTimeout(FormulaParsingError):
+    """The parsing of the input took longer than the allowed time. """
+    pass
+
+
+def parser_worker(connection):
+    """
+    Loop of a parsing process: sends 'ready' once the parser is built, then receives (method name, input) and
+    sends back (status, result or error).
+    """
+    parser = MaterialParserFormulas(cache_size=0)
+    connection.send(('ready',))
+    while True:
+        try:
+            method_name, argument = connection.recv()
+        except EOFError:
+            return
+        try:
+            connection.send(('ok', getattr(parser, method_name)(argument)))
+        except Exception as e:
+            connection.send(('error', type(e).__name__, str(e)))
+
+
+class ParserProcessPool:
+    """
+    Pool of processes running MaterialParserFormulas, where each call is limited to timeout seconds.
+    When a call takes longer, the process is killed and replaced with a new one, and FormulaParsingTimeout is raised.
+
+    A new process imports text2chem and builds its parser before accepting any input: this startup is waited for
+    when the process is started, so that it is not counted in the timeout of the calls.
+    """
+    ERRORS = {'KeyError': KeyError, 'IndexError': IndexError}
+
+    def __init__(self, processes=2, timeout=2.0):
+        self.timeout = timeout
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = queue.Queue()
+        # The processes are started together, then each one is waited for
+        for process, connection in [self.start_worker(wait=False) for _ in range(processes)]:
+            self.wait_ready(process, connection)
+            self.workers.put((process, connection))
+        atexit.register(self.shutdown)
+
+    def start_worker(self, wait=True):
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(target=parser_worker, args=(worker_connection,), daemon=True)
+        process.start()
+        # Closed in this process, so that recv() raises EOFError when the worker dies
+        worker_connection.close()
+        if wait:
+            self.wait_ready(process, connection)
+        return process, connection
+
+    @staticmethod
+    def wait_ready(process, connection):
+        """Wait until the process has built its parser. """
+        try:
+            connection.recv()
+        except EOFError:
+            process.join()
+            raise FormulaParsingError("The parsing process exited with code " + str(process.exitcode)
+                                      + " before being ready.")
+
+    def restart_worker(self, process, connection):
+        process.kill()
+        process.join()
+        connection.close()
+        return self.start_worker()
+
+    def call(self, method_name, argument):
+        process, connection = self.workers.get()
+        try:
+            if not process.is_alive():
+                process, connection = self.restart_worker(process, connection)
+            connection.send((method_name, argument))
+            if not connection.poll(self.timeout):
+                process, connection = self.restart_worker(process, connection)
+                raise FormulaParsingTimeout("The parsing of " + str(argument) + " took more than "
+                                            + str(self.timeout) + " seconds.")
+            output = connection.recv()
+        except (EOFError, OSError) as e:
+            # Not a ValueError: the input is not remembered as impossible to parse
+            process, connection = self.restart_worker(process, connection)
+            raise FormulaParsingError("The parsing process failed: " + type(e).__name__ + " " + str(e))
+        finally:
+            self.workers.put((process, connection))
+
+        if output[0] == 'error':
+            raise self.ERRORS.get(output[1], ValueError)(output[2])
+
+        return output[1]
+
+    def shutdown(self):
+        while not self.workers.empty():
+            process, connection = self.workers.get()
+            connection.close()
+            process.kill()
+
+
 class MaterialParserFormulas:
-    def __init__(self, material_parser=None):
+    def __init__(self, material_parser=None, cache_size=10000, timeout=None, processes=2):
+        """
+            - cache_size: size of the caches of results and failing inputs, 0 disables them
+            - timeout: when set, the text2chem parsing is run in a pool of processes, and each call of
+                formula_to_composition and name_to_formula is limited to timeout seconds
+            - processes: number of parsing processes when the timeout is set
+        """
         if not material_parser:
             material_parser = ParserPipelineBuilder() \
                 .add_preprocessing(AdditivesProcessing) \
@@ -28,6 +144,31 @@ class MaterialParserFormulas:
         self.material2class = Material2Class()
         self.material2tags = Material2Tags()
 
+        self.timeout = timeout
+        self.pool = None
+        if timeout:
+            self.pool = ParserProcessPool(processes=processes, timeout=timeout)
+            self.formula_to_composition = partial(self.pool.call, 'formula_to_composition')
+            self.name_to_formula = partial(self.pool.call, 'name_to_formula')
+
+        # The text2chem pipeline is expensive and the same formulas recur: the results are memoized, the inputs
+        # that cannot be parsed (ValueError) are remembered as well. The timeouts and the failures of the parsing
+        # processes (FormulaParsingError) are not: they depend on the load
+        self.caches = {}
+        if cache_size > 0:
+            for method_name in ['formula_to_composition', 'name_to_formula', 'formula_to_classes']:
+                memoized = Memoizer(getattr(self, method_name), max_size=cache_size, negative_max_size=cache_size,
+                                    negative_exceptions=(ValueError,))
+                setattr(self, method_name, memoized)
+                self.caches[method_name] = memoized
+
+    def stats(self):
+        return {method_name: cache.stats() for method_name, cache in self.caches.items()}
+
+    def configuration(self):
+        """Return the settings that change the results (e.g. to identify the cached results of the material parser). """
+        return {"timeout": self.timeout}
+
     def formula_to_class(self, formula):
         return self.material2class.get_class(formula)
 
@@ -1,13 +1,24 @@
+import hashlib
+import json
+import logging
+import os
 import re
+import threading
 from collections import defaultdict
+from itertools import islice
 from typing import Union
 
 from delft.sequenceLabelling import Sequence
 from delft.sequenceLabelling.models import BidLSTM_CRF
 
 from material_parsers.commons.grobid_tokenizer import tokenizeSimple
+from material_parsers.commons.micro_batching import MicroBatcher
+from material_parsers.commons.result_cache import ResultCache
 from material_parsers.commons.utils import rewrite_comparison_symbol
-from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas
+from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas, FormulaParsingError
+from material_parsers.material_parser.symbolic_composition import SymbolicComposition
+
+LOGGER = logging.getLogger(__name__)
 
 COMPARE_SIGNS = ["≤", "<", "⩽"]
 REPLACEMENT_SYMBOLS_VARIABLES = [(" ͑", "")]
@@ -34,26 +45,120 @@ REPLACEMENT_FORMULA = [
     ()
 ]
 
+# (maximum number of tokens, batch size): the sequences are tagged together with sequences of similar length, so
+# that short material names are not padded to the length of the longest paragraph in the request.
+DEFAULT_LENGTH_BUCKETS = [(16, 128), (64, 64), (256, 32), (None, 8)]
+
+# Maximum number of formulas obtained substituting the combinations of the values of the variables of a material,
+# None for no limit
+DEFAULT_MAX_VARIABLE_EXPANSIONS = None
+
 
 class MaterialParserML:
     def __init__(self,
                  formula_parser: MaterialParserFormulas = None,
-                 model_path: Union[str, None] = "resources/data/models"
+                 model_path: Union[str, None] = "resources/data/models",
+                 micro_batching: bool = False,
+                 max_batch_size: int = 32,
+                 max_wait_ms: int = 5,
+                 length_buckets: Union[list, None] = DEFAULT_LENGTH_BUCKETS,
+                 cache_size: int = 0,
+                 cache_path: Union[str, None] = None,
+                 max_variable_expansions: Union[int, None] = DEFAULT_MAX_VARIABLE_EXPANSIONS,
+                 symbolic_substitution: bool = False
                  ) -> None:
+        self.model_version = ""
         if model_path:
             self.model = Sequence("material-parsers-BidLSTM_CRF", BidLSTM_CRF.name)
             # self.model = Sequence("material-BERT_CRF", BERT_CRF.name)
             self.model.load(dir_path=model_path)
+            self.default_batch_size = self.model.model_config.batch_size
+            self.model_version = model_version(os.path.join(model_path, "material-parsers-BidLSTM_CRF"))
         self.material_parser_wrapper = formula_parser
 
+        # The batch size is set on the shared model configuration: the threads tag one after the other
+        self.tag_lock = threading.Lock()
+        self.length_buckets = length_buckets
+        self.max_variable_expansions = max_variable_expansions
+        self.truncated_variable_expansions = 0
+
+        # When enabled, the formula with variables is parsed once and its composition evaluated for all the values
+        self.symbolic_substitution = symbolic_substitution
+        self.symbolic_compositions = 0
+
+        # Results per sentence, the cached results of a different model or configuration are never used
+        self.cache_namespace = self.model_version + ":" + configuration_version({
+            "max-variable-expansions": max_variable_expansions,
+            "symbolic-substitution": symbolic_substitution,
+            "formula-parser": formula_parser.configuration() if formula_parser else None
+        })
+        self.cache = ResultCache(max_size=cache_size, namespace=self.cache_namespace,
+                                 path=cache_path) if cache_size > 0 else None
+
+        # When enabled, the sentences of concurrent callers are tagged together in a single call of the model
+        self.batcher = MicroBatcher(self.tag, max_batch_size=max_batch_size,
+                                    max_wait_ms=max_wait_ms) if micro_batching else None
+
+    def tag(self, tokenized_input: list):
+        if not self.length_buckets or len(tokenized_input) < 2:
+            return self.tag_batch(tokenized_input)
+
+        results = [None] * len(tokenized_input)
+        for batch_size, indexes in bucket_by_length(tokenized_input, self.length_buckets):
+            bucket_results = self.tag_batch([tokenized_input[index] for index in indexes], batch_size=batch_size)
+            for index, result in zip(indexes, bucket_results):
+                results[index] = result
+
+        return results
+
+    def tag_batch(self, tokenized_input: list, batch_size: int = None):
+        # DeLFT might append a dummy sequence to the input when there is only one sequence
+        input_size = len(tokenized_input)
+
+        # Set directly in the model configuration, as Sequence.tag(batch_size=...) logs it at every call
+        with self.tag_lock:
+            self.model.model_config.batch_size = batch_size if batch_size else self.default_batch_size
+            results = self.model.tag(tokenized_input, "text")
+        if input_size == 1 and len(results) > 1:
+            results = results[:-1]
+
+        return results
+
+    def stats(self):
+        return {
+            "micro_batching": self.batcher.stats() if self.batcher else None,
+            "result_cache": self.cache.stats() if self.cache else None,
+            "truncated_variable_expansions": self.truncated_variable_expansions,
+            "symbolic_compositions": self.symbolic_compositions
+        }
+
     def process(self, input_data: Union[str, list]):
         if type(input_data) is str:
             input_data = [input_data]
 
+        if self.cache is None:
+            return self.process_batch(input_data)
+
+        results = [self.cache.get(text) for text in input_data]
+        missing_indexes = [index for index, result in enumerate(results) if result is None]
+        if missing_indexes:
+            # The results of the sentences where a formula could not be parsed because of the load (timeout or
+            # failure of the parsing process) are incomplete, and are not cached
+            incomplete = set()
+            processed = self.process_batch([input_data[index] for index in missing_indexes], incomplete=incomplete)
+            for position, (index, result) in enumerate(zip(missing_indexes, processed)):
+                if position not in incomplete:
+                    self.cache.put(input_data[index], result)
+                results[index] = result
+
+        return results
+
+    def process_batch(self, input_data: list, incomplete: Union[set, None] = None):
         tokenizer_input = [tokenizeSimple(t) for t in input_data]
-        results = self.model.tag(tokenizer_input, "text")
-        if len(input_data) == 1 and len(results) > 1:
-            results = results[:-1]
+        if self.batcher:
+            results = self.batcher.submit(tokenizer_input)
+        else:
+            results = self.tag(tokenizer_input)
 
         for example in results:
             for i, item in enumerate(example):
@@ -70,14 +175,18 @@ class MaterialParserML:
             [
                 {key: value for key, value in dict(material).items() if value is not None and value != ""} for material in
                 materials
-            ] for materials in self.extract_results(clusters)
+            ] for materials in self.extract_results(clusters, incomplete=incomplete)
         ]
 
         return parsed_results
 
-    def extract_results(self, output):
+    def extract_results(self, output, incomplete: Union[set, None] = None):
+        """
+        Return the materials of each example. The indexes of the examples where a formula could not be parsed
+        because of a timeout or a failure of the parsing process are added to incomplete, when given.
+        """
         results = []
-        for example in output:
+        for example_index, example in enumerate(output):
             shapes = []
             dopings = []
             fabrications = []
@@ -166,7 +275,24 @@ class MaterialParserML:
                 if 'formula' in material and material['formula']:
                     material['formula'] = {'rawValue': material['formula']}
 
-                resolved_formulas = resolve_variables(material)
+                # The combinations of values are substituted lazily, and only up to max_variable_expansions
+                resolved_assignments = list(islice(iterate_resolved_assignments(material),
+                                                   self.max_variable_expansions + 1
+                                                   if self.max_variable_expansions is not None else None))
+                if self.max_variable_expansions is not None and len(
+                        resolved_assignments) > self.max_variable_expansions:
+                    resolved_assignments = resolved_assignments[:self.max_variable_expansions]
+                    material['resolvedFormulasTruncated'] = True
+                    self.truncated_variable_expansions += 1
+                    print(f"The substitution of the variables in {material['formula']['rawValue']} was truncated "
+                          f"to {self.max_variable_expansions} formulas")
+
+                resolved_formulas = [formula for formula, _ in resolved_assignments]
+
+                symbolic_compositions = {}
+                if self.symbolic_substitution and self.material_parser_wrapper and len(resolved_assignments) > 1:
+                    symbolic_compositions = self.evaluate_symbolic_compositions(material['formula']['rawValue'],
+                                                                                resolved_assignments)
 
                 # If there are no resolved formulas (no variable), but there is a raw formula, add it
                 if not resolved_formulas and 'formula' in material and material['formula'] and (
@@ -181,7 +307,9 @@ class MaterialParserML:
                             new_f = {
                                 "rawValue": exp_f,
                             }
-                            if self.material_parser_wrapper:
+                            if exp_f in symbolic_compositions:
+                                new_f["formulaComposition"] = symbolic_compositions[exp_f]
+                            elif self.material_parser_wrapper:
                                 try:
                                     compo = self.material_parser_wrapper.formula_to_composition(exp_f)
                                     if compo and 'composition' in compo:
@@ -190,6 +318,10 @@ class MaterialParserML:
                                     print(f"Cannot parse (formula to composition) {exp_f} with the material parser")
                                 except IndexError as ie:
                                     print(f"Cannot parse (formula to composition) {exp_f}, index error: {ie}")
+                                except FormulaParsingError as pe:
+                                    LOGGER.warning("Cannot parse (formula to composition) %s: %s", exp_f, pe)
+                                    if incomplete is not None:
+                                        incomplete.add(example_index)
 
                             resolved_and_expanded_formulas.append(new_f)
 
@@ -206,6 +338,10 @@ class MaterialParserML:
                             converted_formula = self.material_parser_wrapper.name_to_formula(material['name'])
                         except ValueError:
                             print(f"Cannot parse (name to formula) {material['name']} with material parser")
+                        except FormulaParsingError as pe:
+                            LOGGER.warning("Cannot parse (name to formula) %s: %s", material['name'], pe)
+                            if incomplete is not None:
+                                incomplete.add(example_index)
 
                         formula = None
 
@@ -223,6 +359,79 @@ class MaterialParserML:
 
         return results
 
+    def evaluate_symbolic_compositions(self, formula, resolved_assignments):
+        """
+        Return the compositions of the resolved formulas (dict formula -> composition) evaluated from the
+        composition of the formula with variables, parsed once. The formulas that cannot be evaluated exactly are
+        missing and are parsed one by one. The evaluated compositions of the first and last formulas are checked
+        against their parsing: when they differ (e.g. a variable substituted inside an element name), none is used.
+        """
+        try:
+            if expand_formula(formula) != [formula]:
+                return {}
+            compo = self.material_parser_wrapper.formula_to_composition(formula)
+        except (ValueError, IndexError, RuntimeError, FormulaParsingError):
+            return {}
+
+        variables = list(resolved_assignments[0][1].keys())
+        symbolic_composition = SymbolicComposition.compile(compo.get('composition'), variables)
+        if symbolic_composition is None:
+            return {}
+
+        candidates = [(f, assignment) for f, assignment in resolved_assignments if expand_formula(f) == [f]]
+        evaluated = [(f, composition) for (f, _), composition in
+                     zip(candidates, symbolic_composition.evaluate([assignment for _, assignment in candidates]))
+                     if composition is not None]
+        if not evaluated:
+            return {}
+
+        for f, composition in {evaluated[0][0]: evaluated[0][1], evaluated[-1][0]: evaluated[-1][1]}.items():
+            try:
+                compo = self.material_parser_wrapper.formula_to_composition(f)
+            except (ValueError, IndexError, FormulaParsingError):
+                return {}
+            if 'composition' not in compo or list(compo['composition'].items()) != list(composition.items()):
+                return {}
+
+        self.symbolic_compositions += len(evaluated)
+        return dict(evaluated)
+
+
+def model_version(model_directory):
+    """Identify a model by the hash of the files in its directory (configuration, preprocessor and weights). """
+    sha = hashlib.sha1()
+    for file_name in sorted(os.listdir(model_directory)):
+        sha.update(file_name.encode('utf-8'))
+        with open(os.path.join(model_directory, file_name), 'rb') as fp:
+            sha.update(fp.read())
+
+    return sha.hexdigest()
+
+
+def configuration_version(configuration):
+    """Identify a configuration by the hash of its JSON serialisation. """
+    return hashlib.sha1(json.dumps(configuration, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def bucket_by_length(sequences, buckets):
+    """
+    Group the sequences by length. Each bucket is a tuple (maximum length, batch size), the last bucket can have
+    None as maximum length. The sequences longer than every bucket fall in the last one.
+
+    Return a list of (batch size, indexes of the sequences) with the indexes sorted by the sequence length.
+    """
+    groups = [[] for _ in buckets]
+    for index in sorted(range(len(sequences)), key=lambda i: len(sequences[i])):
+        length = len(sequences[index])
+        bucket_index = len(buckets) - 1
+        for i, (max_length, _) in enumerate(buckets):
+            if max_length is None or length <= max_length:
+                bucket_index = i
+                break
+        groups[bucket_index].append(index)
+
+    return [(buckets[i][1], indexes) for i, indexes in enumerate(groups) if indexes]
+
 
 def process_property(materials, property_name, property_values_list):
     if len(property_values_list) > 1:
@@ -274,66 +483,111 @@ def post_process_variable(variable: str) -> str:
     return temp
 
 
-def resolve_variables(material):
+def resolve_variables(material, max_expansions=None):
+    """Return the formulas of iterate_resolved_variables(), at most max_expansions when set"""
+    return list(islice(iterate_resolved_variables(material), max_expansions))
+
+
+def iterate_resolved_variables(material):
+    """
+    Yield lazily the distinct formulas obtained substituting the values of the variables in the formula of the
+    material. When the values cannot be substituted, the values cleaned of any character that is not part
+    of a number are tried.
+    """
+    for formula, _ in iterate_resolved_assignments(material):
+        yield formula
+
+
+def iterate_resolved_assignments(material):
+    """
+    Yield lazily the distinct formulas of iterate_resolved_variables(), each with the values substituted to the
+    variables (dict variable -> value).
+    """
     if not ('variables' in material and material['variables']) or not ('formula' in material and material[
         'formula']) or not ('rawValue' in material['formula'] and material['formula']['rawValue']):
-        return []
+        return
 
     formula_raw_value = material['formula']['rawValue']
 
     if not any(variable in formula_raw_value for variable in material['variables']):
-        return []
+        return
 
     variables = set(material['variables'].keys())
-    contained_variables = {var for var in variables if var in formula_raw_value}
-
-    output_formulas_string = []
+    contained_variables = [var for var in material['variables'] if var in formula_raw_value]
 
     if not contained_variables:
-        return output_formulas_string
+        return
 
     if len(contained_variables) != len(variables):
         print("While processing the variables, some are not present in the material formula and "
-              "won't be substituted: " + str(variables - contained_variables))
+              "won't be substituted: " + str(variables - set(contained_variables)))
 
-    map_of_contained_variables = {variable: material['variables'][variable] for variable in contained_variables}
+    values = [material['variables'][variable] for variable in contained_variables]
 
+    seen = set()
     try:
-        generate_permutations(map_of_contained_variables, list(contained_variables), output_formulas_string,
-                              (0, 0), formula_raw_value)
+        for formula, assignment in generate_assignments(formula_raw_value, contained_variables, values):
+            if formula not in seen:
+                seen.add(formula)
+                yield formula, dict(zip(contained_variables, assignment))
     except ValueError:
-        cleaned_map_of_contained_variables = {}
-        for variable in map_of_contained_variables:
-            cleaned_list = [re.sub("[^\\-0-9.]+", "", value) for value in map_of_contained_variables[variable]]
-            cleaned_map_of_contained_variables[variable] = cleaned_list
+        cleaned_values = [[re.sub("[^\\-0-9.]+", "", value) for value in values_of_variable]
+                          for values_of_variable in values]
 
         try:
-            generate_permutations(cleaned_map_of_contained_variables, list(contained_variables),
-                                  output_formulas_string, (0, 0), formula_raw_value)
+            for formula, assignment in generate_assignments(formula_raw_value, contained_variables, cleaned_values):
+                if formula not in seen:
+                    seen.add(formula)
+                    yield formula, dict(zip(contained_variables, assignment))
         except ValueError:
             print("Cannot replace variables " + str(list(variables)))
 
-    return output_formulas_string
 
+def generate_substitutions(formula, variables, values):
+    """
+    Yield lazily the formula with each combination of the values substituted to the variables, the last
+    variable changing first. The substitutions of the first variables are kept and reused for all the
+    combinations of the following ones, and the repeated values of a variable are substituted once.
+    Each partial formula is compiled once in a FormulaTemplate, used for all the values of the next variable.
+    """
+    for substituted_formula, _ in generate_assignments(formula, variables, values):
+        yield substituted_formula
 
-def generate_permutations(input_dict, key_list, result, depth, formula):
-    variable_index, value_index = depth
 
-    variable = key_list[variable_index]
-    value = input_dict[variable][value_index]
-
-    if value_index == len(input_dict[variable]) - 1 and variable_index == len(key_list) - 1:
-        result.append(replace_variable(formula, variable, value))
+def generate_assignments(formula, variables, values):
+    """Yield the formulas of generate_substitutions(), each with the tuple of the values substituted. """
+    values = [list(dict.fromkeys(values_of_variable)) for values_of_variable in values]
+    if not variables or any(len(values_of_variable) == 0 for values_of_variable in values):
         return
 
-    if variable_index == len(key_list) - 1:
-        result.append(replace_variable(formula, variable, value))
-        generate_permutations(input_dict, key_list, result, (variable_index, value_index + 1), formula)
-        return
+    # partial_formulas[i] is the formula with the first i variables substituted, templates[i] its template
+    partial_formulas = [formula] + [None] * len(variables)
+    templates = [None] * len(variables)
+    indexes = [0] * len(variables)
+    changed_variable = 0
+
+    while True:
+        for i in range(changed_variable, len(variables)):
+            if templates[i] is None or templates[i].formula != partial_formulas[i]:
+                templates[i] = FormulaTemplate(partial_formulas[i], variables[i])
+            partial_formulas[i + 1] = templates[i].substitute(values[i][indexes[i]])
+        yield partial_formulas[-1], tuple(values[i][indexes[i]] for i in range(len(variables)))
+
+        changed_variable = len(variables) - 1
+        while changed_variable >= 0 and indexes[changed_variable] == len(values[changed_variable]) - 1:
+            indexes[changed_variable] = 0
+            changed_variable -= 1
+        if changed_variable < 0:
+            return
+        indexes[changed_variable] += 1
+
 
-    for i in range(len(input_dict[variable])):
-        generate_permutations(input_dict, key_list, result, (variable_index + 1, 0),
-                              replace_variable(formula, variable, input_dict[variable][i]))
+def generate_permutations(input_dict, key_list, result, depth, formula):
+    variable_index, value_index = depth
+    values = [input_dict[variable] for variable in key_list[variable_index:]]
+    values[0] = values[0][value_index:]
+
+    result.extend(generate_substitutions(formula, key_list[variable_index:], values))
 
 
 def replace_variable(formula, variable, value):
@@ -375,6 +629,111 @@ def replace_variable(formula, variable, value):
     return return_formula
 
 
+class FormulaTemplate:
+    """
+    A formula compiled for the substitution of a variable: the formula is parsed once in literal segments and
+    slots, and substitute() only fills the slots with the value, giving the same string as replace_variable().
+
+    The slots are the occurrences of the variable, alone, after a minus ("-x") or after a number ("1-x", the
+    value is subtracted from the number). When the formula or the value could make replace_variable() substitute
+    a different occurrence than the one found (e.g. an occurrence that is not substituted followed by one that is,
+    or a value sharing characters with the variable), substitute() falls back to replace_variable().
+    """
+    VALUE = 0
+    DIFFERENCE = 1
+    NEGATED = 2
+
+    # Characters of the string of a float (e.g. -0.1, 1e-05, inf, nan)
+    NUMBER_CHARACTERS = set("0123456789.-+einfa")
+
+    def __init__(self, formula, variable):
+        self.formula = formula
+        self.variable = variable
+        self.variable_characters = set(variable)
+        self.segments = []
+        self.slots = []
+        self.ignored_occurrences = 0
+        self.exact = self.compile()
+        self.check_differences = not self.variable_characters.isdisjoint(self.NUMBER_CHARACTERS)
+
+    def compile(self):
+        formula = self.formula
+        variable = self.variable
+        if not variable:
+            return False
+
+        occurrences = []
+        start_searching = 0
+        while formula.find(variable, start_searching) > -1:
+            occurrences.append(formula.find(variable, start_searching))
+            start_searching = occurrences[-1] + 1
+
+        segment_start = 0
+        for index, variable_index in enumerate(occurrences):
+            if index > 0 and variable_index < occurrences[index - 1] + len(variable):
+                return False
+
+            if formula.startswith("-", variable_index - 1) or formula.startswith("\u2212", variable_index - 1):
+                if variable_index == 0:
+                    return False
+                end_search = variable_index - 1
+                while end_search > 0 and formula[end_search - 1].isdigit():
+                    end_search -= 1
+
+                if end_search < variable_index - 1:
+                    slot_start = end_search
+                    slot = (self.DIFFERENCE, float(formula[end_search: variable_index - 1]))
+                else:
+                    if formula[variable_index - 1] in variable:
+                        return False
+                    slot_start = variable_index - 1
+                    slot = (self.NEGATED, formula[variable_index - 1])
+            elif (variable_index + len(variable) < len(formula) - 1 and not formula[
+                variable_index + len(variable)].islower()) or variable_index + len(variable) == len(formula):
+                slot_start = variable_index
+                slot = (self.VALUE, None)
+            else:
+                # Not substituted, replace_variable() would substitute it instead of the following occurrences
+                if index < len(occurrences) - 1:
+                    return False
+                if variable_index + len(variable) == len(formula) - 1:
+                    self.ignored_occurrences += 1
+                continue
+
+            if slot_start < segment_start:
+                return False
+            self.segments.append(formula[segment_start: slot_start])
+            self.slots.append(slot)
+            segment_start = variable_index + len(variable)
+
+        self.segments.append(formula[segment_start:])
+        return True
+
+    def substitute(self, value):
+        # The substituted text must not contain any part of an occurrence of the variable
+        if not self.exact or not self.variable_characters.isdisjoint(value):
+            return replace_variable(self.formula, self.variable, value)
+
+        parts = [self.segments[0]]
+        for (slot_type, argument), segment in zip(self.slots, self.segments[1:]):
+            if slot_type == self.DIFFERENCE:
+                text = str(round(argument - float(value), 2))
+                if self.check_differences and not self.variable_characters.isdisjoint(text):
+                    return replace_variable(self.formula, self.variable, value)
+            elif slot_type == self.NEGATED:
+                text = value[1:] if value.startswith("-") or value.startswith("\u2212") else argument + value
+            else:
+                text = value
+
+            parts.append(text)
+            parts.append(segment)
+
+        for _ in range(self.ignored_occurrences):
+            print("The variable " + self.variable + " substitution with value " + value + " into " + self.formula)
+
+        return "".join(parts)
+
+
 def expand_formula(formula):
     regex = r"^ ?\(([A-Za-z, ]+)\)(.*)"
     formula_dopant_pattern = re.compile(regex)
@@ -0,0 +1,92 @@
+import re
+from collections import OrderedDict
+
+import numpy as np
+import sympy
+
+# The values substituted exactly: the formulas resolved by replace_variable() round the differences (e.g. 1-x) to
+# two decimals, which is exact only for the values with at most two decimals
+PATTERN_EXACT_VALUE = re.compile(r"^[0-9]+(\.[0-9]{1,2})?$")
+
+PATTERN_SYMBOL = re.compile(r"[^\W\d]\w*")
+
+
+def parse_value(value):
+    """Return the value of a variable as a float, or None when it cannot be evaluated exactly. """
+    value = str(value).strip()
+    if not PATTERN_EXACT_VALUE.match(value):
+        return None
+
+    return float(value)
+
+
+def format_amount(amount):
+    """Format a numeric amount as text2chem does (rounded to three decimals, without the trailing .0). """
+    return re.sub(r"\.0+(?![0-9])", "", str(round(float(amount) + 0.0, 3)))
+
+
+class SymbolicComposition:
+    """
+    The composition of a formula containing variables (e.g. Fe1-xCuxO2 -> Fe: 1-x, Cu: x, O: 2), parsed once,
+    and evaluated numerically for many values of the variables at once.
+
+    Use compile(), which returns None when the composition does not depend on all the variables, or depends on
+    something else (e.g. an oxygen deficiency, which text2chem drops from the composition).
+    """
+
+    def __init__(self, composition, variables, expressions):
+        self.elements = list(composition.keys())
+        self.variables = list(variables)
+        self.symbols = [sympy.Symbol(variable) for variable in self.variables]
+        self.functions = [sympy.lambdify(self.symbols, expression, modules="numpy", dummify=True)
+                          for expression in expressions]
+
+    @classmethod
+    def compile(cls, composition, variables):
+        if not composition or not variables:
+            return None
+
+        expressions = []
+        used_variables = set()
+        for amount in composition.values():
+            amount = str(amount)
+            local_symbols = {name: sympy.Symbol(name) for name in PATTERN_SYMBOL.findall(amount)}
+            try:
+                expression = sympy.sympify(amount, locals=local_symbols)
+            except (sympy.SympifyError, TypeError, SyntaxError):
+                return None
+
+            names = {symbol.name for symbol in expression.free_symbols}
+            if not names.issubset(variables):
+                return None
+            used_variables.update(names)
+            expressions.append(expression)
+
+        if used_variables != set(variables):
+            return None
+
+        return cls(composition, variables, expressions)
+
+    def evaluate(self, assignments):
+        """
+        Return the composition for each assignment (a dict variable -> value), or None for the assignments that
+        cannot be evaluated exactly (see parse_value) or giving a negative amount, which text2chem does not accept.
+        """
+        values = [[parse_value(assignment.get(variable)) for variable in self.variables] for assignment in assignments]
+        evaluable = [index for index, row in enumerate(values) if all(value is not None for value in row)]
+
+        results = [None] * len(assignments)
+        if not evaluable:
+            return results
+
+        columns = np.array([values[index] for index in evaluable], dtype=float).T
+        amounts = np.stack([np.broadcast_to(np.asarray(function(*columns), dtype=float), (len(evaluable),))
+                            for function in self.functions])
+        valid = np.all(amounts >= 0, axis=0) & np.all(np.isfinite(amounts), axis=0)
+
+        for position, index in enumerate(evaluable):
+            if valid[position]:
+                results[index] = OrderedDict(
+                    (element, format_amount(amount)) for element, amount in zip(self.elements, amounts[:, position]))
+
+        return results
@@ -1,22 +1,86 @@
 import json
+import multiprocessing
 import os
 from ast import literal_eval
 
 import bottle
-import spacy
 from bottle import request, response, run
 
-from material_parsers.linking.linking_module import RuleBasedLinker, CriticalTemperatureClassifier
-from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas
-from material_parsers.material_parser.material_parser_ml import MaterialParserML
+from material_parsers.commons.component_loader import ComponentLoader
+from material_parsers.commons.compression import CompressionPlugin
+from material_parsers.commons.serialization import JsonSerializer
+from material_parsers.commons.spacy_pipelines import SpacyPipelineManager
+from material_parsers.commons.streaming import iter_lines, parse_text_line, iter_batches, \
+    is_chunked_body_undecoded
+from material_parsers.linking.linking_module import RuleBasedLinker, CriticalTemperatureClassifier, ParagraphAnalysis
+from material_parsers.linking.relationships_resolver import VicinityResolutionResolver
+from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas, FormulaParsingTimeout, \
+    FormulaParsingError
 
 bottle.BaseRequest.MEMFILE_MAX = 1024 * 1024 * 1024
 
 
 class Service(object):
 
-    def __init__(self):
-        spacy_nlp = spacy.load("en_core_web_sm", disable=['ner', "textcat", "lemmatizer", "tokenizer"])
+    def __init__(self, configuration=None):
+        configuration = configuration if configuration is not None else {}
+
+        linking_configuration = configuration.get('linking', {})
+        self.linking_batch_size = linking_configuration.get('batch-size', 32)
+        self.linking_n_process = linking_configuration.get('n-process', 1)
+        self.fast_tc_classification = linking_configuration.get('fast-tc-classification', False)
+
+        self.label_link = {
+            'material-tcValue': '<material>',
+            'tcValue-pressure': '<pressure>',
+            'tcValue-me_method': '<me_method>',
+            'material-crystal_structure': '<material>',
+            'material-space_groups': '<material>'
+        }
+
+        self.ner = None
+
+        serialization_configuration = configuration.get('serialization', {})
+        self.serializer = JsonSerializer(serialization_configuration.get('library', JsonSerializer.AUTO))
+        self.pretty_json = serialization_configuration.get('pretty', False)
+
+        self.version = None
+
+        ml_configuration = configuration.get('material-parser', {})
+        self.stream_batch_size = ml_configuration.get('stream-batch-size', 32)
+
+        # With background loading the models are loaded in parallel threads, and the routes answer 503 until
+        # the components they need are ready
+        service_configuration = configuration.get('service', {})
+        self.retry_after = service_configuration.get('retry-after', 5)
+        self.loader = ComponentLoader(background=service_configuration.get('background-loading', False))
+        self.loader.load('spacy', lambda: self.load_spacy_pipelines(configuration))
+        self.loader.load('formula-parser', lambda: self.load_formula_parser(configuration.get('formula-parser', {})))
+        self.loader.load('material-parser', lambda: self.load_material_parser(ml_configuration),
+                         requires=['formula-parser'])
+
+    @staticmethod
+    def has_structure_patterns(configuration):
+        return 'space-groups' in configuration and 'crystal-structure' in configuration
+
+    def load_spacy_pipelines(self, configuration):
+        """
+        Load the spaCy model once, shared by the linkers (tagger and parser) and by the structure NER
+        (lemmatizer and entity rulers of the space groups and crystal structures)
+        """
+        self.spacy_pipelines = SpacyPipelineManager("en_core_web_sm")
+        if self.has_structure_patterns(configuration):
+            print("Loading space groups patterns...")
+            self.spacy_pipelines.add_entity_ruler("entity_ruler_space_groups", configuration['space-groups'])
+
+            print("Loading crystal structure patterns...")
+            self.spacy_pipelines.add_entity_ruler("crystal_structure", configuration['crystal-structure'])
+        self.spacy_pipelines.add_default_views()
+
+        self.load_linkers(configuration.get('linking', {}), self.spacy_pipelines.get_view(SpacyPipelineManager.LINKING))
+        self.ner = self.spacy_pipelines.get_view(SpacyPipelineManager.STRUCTURE)
+
+    def load_linkers(self, linking_configuration, spacy_nlp):
         self.linker_material_tcValue = RuleBasedLinker(source="<tcValue>", destination="<material>",
                                                        spacy_nlp=spacy_nlp)
         self.linker_tcValue_pressure = RuleBasedLinker(source="<pressure>", destination="<tcValue>",
@@ -29,8 +93,9 @@ class Service(object):
         self.linker_material_space_groups = RuleBasedLinker(source="<material>", destination="<space-groups>",
                                                             spacy_nlp=spacy_nlp)
 
-        self.temperature_classifier = CriticalTemperatureClassifier()
-        self.linker_map = {
+        self.temperature_classifier = CriticalTemperatureClassifier(spacy_nlp)
+
+        linker_map = {
             'material-tcValue': self.linker_material_tcValue,
             'tcValue-pressure': self.linker_tcValue_pressure,
             'tcValue-me_method': self.linker_tcValue_me_method,
@@ -38,21 +103,72 @@ class Service(object):
             'material-space_groups': self.linker_material_space_groups
         }
 
-        self.label_link = {
-            'material-tcValue': '<material>',
-            'tcValue-pressure': '<pressure>',
-            'tcValue-me_method': '<me_method>',
-            'material-crystal_structure': '<material>',
-            'material-space_groups': '<material>'
-        }
-
-        self.ner = None
-
-        self.version = None
-
-        self.material_parser_wrapper = MaterialParserFormulas()
+        # The assignment strategy can be the same for all the linkers, or given for each link type
+        assignment = linking_configuration.get('assignment', VicinityResolutionResolver.GREEDY_ASSIGNMENT)
+        for link_type, linker in linker_map.items():
+            linker.resolver = VicinityResolutionResolver(
+                assignment.get(link_type, VicinityResolutionResolver.GREEDY_ASSIGNMENT)
+                if type(assignment) is dict else assignment)
+
+        self.linker_map = linker_map
+
+    def load_formula_parser(self, formula_parser_configuration):
+        self.material_parser_wrapper = MaterialParserFormulas(
+            cache_size=formula_parser_configuration.get('cache-size', 10000),
+            timeout=formula_parser_configuration.get('timeout', None),
+            processes=formula_parser_configuration.get('processes', 2))
+
+    def load_material_parser(self, ml_configuration):
+        # Imported here, as importing DeLFT loads TensorFlow
+        from material_parsers.material_parser.material_parser_ml import MaterialParserML, DEFAULT_LENGTH_BUCKETS, \
+            DEFAULT_MAX_VARIABLE_EXPANSIONS
+
+        self.ml_parser = MaterialParserML(self.material_parser_wrapper,
+                                          micro_batching=ml_configuration.get('micro-batching', False),
+                                          max_batch_size=ml_configuration.get('max-batch-size', 32),
+                                          max_wait_ms=ml_configuration.get('max-wait-ms', 5),
+                                          length_buckets=ml_configuration.get('length-buckets',
+                                                                              DEFAULT_LENGTH_BUCKETS),
+                                          cache_size=ml_configuration.get('cache-size', 0),
+                                          cache_path=ml_configuration.get('cache-path', None),
+                                          max_variable_expansions=ml_configuration.get(
+                                              'max-variable-expansions', DEFAULT_MAX_VARIABLE_EXPANSIONS),
+                                          symbolic_substitution=ml_configuration.get('symbolic-substitution', False))
+
+    def requires(self, components, callback):
+        """Wrap a route, which answers 503 while the components it needs are not loaded. """
+
+        def wrapper(*args, **kwargs):
+            not_ready = self.loader.not_ready(components)
+            if not_ready:
+                response.status = 503
+                response.content_type = 'application/json'
+                failed = self.loader.failed(not_ready)
+                if failed:
+                    return self.to_json({"message": "The service could not load " + ", ".join(failed) + ".",
+                                         "components": failed})
+                response.set_header('Retry-After', str(self.retry_after))
+                return self.to_json({"message": "The service is loading " + ", ".join(not_ready) + ".",
+                                     "components": not_ready})
+
+            return callback(*args, **kwargs)
+
+        return wrapper
+
+    def get_ready(self):
+        status = self.loader.status()
+        if not status['ready']:
+            response.status = 503
+            if not self.loader.failed(self.loader.components.keys()):
+                response.set_header('Retry-After', str(self.retry_after))
+        response.content_type = 'application/json'
+        return self.to_json(status)
 
-        self.ml_parser = MaterialParserML(self.material_parser_wrapper)
+    def to_json(self, data):
+        """Serialise a response, pretty-printed when configured or requested with the query parameter pretty=true. """
+        pretty = request.query.get("pretty")
+        pretty = pretty.lower() == 'true' if pretty is not None else self.pretty_json
+        return self.serializer.dumps(data, pretty=pretty)
 
     def get_version(self):
         if self.version is None:
@@ -66,6 +182,15 @@ class Service(object):
         info_json = {"name": "materials parsers and tools", "version": self.version}
         return info_json
 
+    def get_stats(self):
+        """Report the statistics of each loaded component, null for the components still loading or failed. """
+        not_ready = self.loader.not_ready(['formula-parser', 'material-parser'])
+        response.content_type = 'application/json'
+        return self.to_json({
+            "material_parser": self.ml_parser.stats() if 'material-parser' not in not_ready else None,
+            "formula_parser": self.material_parser_wrapper.stats() if 'formula-parser' not in not_ready else None
+        })
+
     def classify_tc(self):
         input_raw = request.forms.get("input")
 
@@ -74,24 +199,29 @@ class Service(object):
             return 'Required a parameter "input" as form-data.'
 
         try:
-            passages_input = json.loads(input_raw)
+            passages_input = self.serializer.loads(input_raw)
         except:
             response.status = 400
             return 'Invalid JSON file provided in input.'
 
+        # The fast classification skips tagger and parser, which are not used to classify the temperatures
+        fast = request.forms.get("fast")
+        fast = fast.lower() == 'true' if fast is not None else self.fast_tc_classification
+
         single = False
         if type(passages_input) is dict:
             single = True
             passages_input = [passages_input]
 
-        result = []
-        for passage in passages_input:
-            result.append(self.temperature_classifier.mark_temperatures_paragraph(passage))
+        result = self.temperature_classifier.mark_temperatures_paragraphs(passages_input,
+                                                                          batch_size=self.linking_batch_size,
+                                                                          n_process=self.linking_n_process,
+                                                                          fast=fast)
 
         if single:
             result = result[0]
 
-        return json.dumps(result)
+        return self.to_json(result)
 
     def process_link(self):
         """
@@ -102,12 +232,12 @@ class Service(object):
         input_raw = request.forms.get("input")
         passages_input = None
         try:
-            passages_input = json.loads(input_raw)
+            passages_input = self.serializer.loads(input_raw)
         except:
             response.status = 400
             return 'Invalid JSON file provided in input.'
 
-        link_types_as_list = json.loads(request.forms.get("types")) if request.forms.get(
+        link_types_as_list = self.serializer.loads(request.forms.get("types")) if request.forms.get(
             "types") is not None else self.linker_map.keys()
         skip_classification = request.forms.get("skip_classification") if request.forms.get(
             "skip_classification") is not None else "False"
@@ -118,13 +248,21 @@ class Service(object):
             single = True
             passages_input = [passages_input]
 
-        for sentence_input in passages_input:
-            result.append(self.process_single_sentence(sentence_input, link_types_as_list, skip_classification))
+        # The paragraphs that are parsed (by the classifier or a linker) are tagged and parsed together, in batches
+        analyses = [self.get_analysis_to_parse(sentence_input, link_types_as_list,
+                                               skip_classification.lower() == 'true')
+                    for sentence_input in passages_input]
+        ParagraphAnalysis.parse([analysis for analysis in analyses if analysis is not None],
+                                batch_size=self.linking_batch_size, n_process=self.linking_n_process)
+
+        for sentence_input, analysis in zip(passages_input, analyses):
+            result.append(
+                self.process_single_sentence(sentence_input, link_types_as_list, skip_classification, analysis))
 
         if single:
             result = result[0]
 
-        return json.dumps(result)
+        return self.to_json(result)
 
     def process_material(self):
         input_raw = request.forms.get("texts")
@@ -146,16 +284,61 @@ class Service(object):
         results = self.ml_parser.process(input_split)
 
         response.content_type = 'application/json'
-        return json.dumps(results, indent=4)
+        return self.to_json(results)
+
+    def process_material_stream(self):
+        """
+        Process a body of NDJSON or newline-delimited text incrementally: the lines are read from the request
+        in batches of stream_batch_size, and the results of each batch are written back as NDJSON (one object
+        per non-empty line) before the next batch is read.
+        """
+        if is_chunked_body_undecoded(request.environ):
+            response.status = 411
+            return 'The chunked transfer encoding is not supported by the development server, send the Content-Length.'
+
+        stream = request.environ['wsgi.input']
+        content_length = request.content_length
+        if content_length < 0 and 'chunked' not in request.environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            content_length = 0
+
+        texts = (text for text in map(parse_text_line, iter_lines(stream, content_length)) if text is not None)
+
+        def results_stream():
+            for batch in iter_batches(texts, self.stream_batch_size):
+                results = self.ml_parser.process(batch)
+                yield "".join(self.serializer.dumps({"text": text, "materials": materials}) + "\n"
+                              for text, materials in zip(batch, results))
+
+        response.content_type = 'application/x-ndjson'
+        return results_stream()
+
+    @staticmethod
+    def is_valid_sentence(paragraph_input):
+        return paragraph_input is not None and 'tokens' in paragraph_input and 'text' in paragraph_input
+
+    def get_analysis_to_parse(self, paragraph_input, link_types_as_list, skip_classification):
+        """
+        Return the analysis of the paragraph when it will be parsed by the classifier or by one of the linkers,
+        otherwise None: the paragraphs without entities to link are not parsed.
+        """
+        if not self.is_valid_sentence(paragraph_input) or len(paragraph_input.get('spans', [])) == 0:
+            return None
+
+        # The classifier parses every paragraph, the linkers only the paragraphs with source and destination types
+        if skip_classification and not any(self.linker_map[link_type].is_linkable(paragraph_input['spans'])
+                                           for link_type in link_types_as_list if link_type in self.linker_map):
+            return None
 
-    def process_single_sentence(self, paragraph_input, link_types_as_list, skip_classification):
+        return ParagraphAnalysis(self.temperature_classifier, paragraph_input)
+
+    def process_single_sentence(self, paragraph_input, link_types_as_list, skip_classification, analysis=None):
         """Link entities in a single sentence"""
         if skip_classification.lower() == 'true':
             skip_classification = True
         else:
             skip_classification = False
 
-        if paragraph_input is None or 'tokens' not in paragraph_input or 'text' not in paragraph_input:
+        if not self.is_valid_sentence(paragraph_input):
             response.status = 400
             return 'Missing paragraphs, tokens or text.'
 
@@ -165,8 +348,13 @@ class Service(object):
         if len(paragraph_input['spans']) == 0:
             return paragraph_input
 
+        # The paragraph is tagged and parsed once, and the document is shared by the classifier and the linkers
+        if analysis is None:
+            analysis = ParagraphAnalysis(self.temperature_classifier, paragraph_input)
+
         if not skip_classification:
-            marked_tc_paragraph = self.temperature_classifier.mark_temperatures_paragraph(paragraph_input)
+            marked_tc_paragraph = self.temperature_classifier.mark_temperatures_analysis(analysis,
+                                                                                        paragraph_input['spans'])
             if 'spans' not in marked_tc_paragraph or len(marked_tc_paragraph['spans']) == 0:
                 return paragraph_input
 
@@ -188,7 +376,8 @@ class Service(object):
                                    paragraph_input['spans'] if 'spans' in paragraph_input else []):
                     span['linkable'] = True
 
-            processed_linked_map[link_type] = self.linker_map[link_type].process_paragraph(paragraph_input)
+            processed_linked_map[link_type] = self.linker_map[link_type].process_analysis(analysis,
+                                                                                          paragraph_input['spans'])
 
         for link_type in link_types_as_list:
             processed_linked = processed_linked_map[link_type]
@@ -239,11 +428,15 @@ class Service(object):
             except ValueError as ve:
                 results.append(
                     {'code': 400, 'message': 'The parser was not able to process the provided input: ' + str(ve)})
+            except FormulaParsingTimeout as te:
+                results.append({'code': 408, 'message': str(te)})
+            except FormulaParsingError as pe:
+                results.append({'code': 503, 'message': str(pe)})
 
         if len(results) == 1:
-            return json.dumps(results[0])
+            return self.to_json(results[0])
         else:
-            return json.dumps(results)
+            return self.to_json(results)
 
     def is_response_empty(self, formula):
         return ('name' in formula and formula['name'] == "") and ('formula' in formula and formula['formula'] == "")
@@ -271,13 +464,23 @@ class Service(object):
                     'code': 400,
                     'message': 'The parser was not able to process the provided input: KeyError ' + str(ke)
                 }
+            except FormulaParsingTimeout as te:
+                composition = {
+                    'code': 408,
+                    'message': str(te)
+                }
+            except FormulaParsingError as pe:
+                composition = {
+                    'code': 503,
+                    'message': str(pe)
+                }
 
             results.append(composition)
 
         if len(results) == 1:
-            return json.dumps(results[0])
+            return self.to_json(results[0])
         else:
-            return json.dumps(results)
+            return self.to_json(results)
 
     def classify_formula(self):
         raw = request.forms.get("input")
@@ -288,7 +491,7 @@ class Service(object):
 
         classes = self.material_parser_wrapper.formula_to_classes(raw)
 
-        return json.dumps(list(classes.keys()))
+        return self.to_json(list(classes.keys()))
 
     def process_structure_text(self):
         input_raw = request.forms.get("input")
@@ -299,7 +502,7 @@ class Service(object):
 
         passages_input = None
         try:
-            passages_input = json.loads(input_raw)
+            passages_input = self.serializer.loads(input_raw)
         except:
             bottle.response.status = 400
             return 'Invalid JSON file provided in input.'
@@ -315,7 +518,7 @@ class Service(object):
 
             output.append(entities)
 
-        return json.dumps(output)
+        return self.to_json(output)
 
     @staticmethod
     def get_type(input_data):
@@ -326,42 +529,93 @@ class Service(object):
             return str
 
 
-def init(host='0.0.0.0', port='8080', config="config.json", development=False):
-    app = Service()
-
-    bottle.route('/process/link', method="POST")(app.process_link)
-    bottle.route('/process/material', method="POST")(app.process_material)
-
-    bottle.route('/convert/name/formula', method="POST")(app.name_to_formula)
-    bottle.route('/convert/formula/composition', method="POST")(app.formula_to_composition)
-
-    bottle.route('/classify/tc', method="POST")(app.classify_tc)
-    bottle.route('/classify/formula', method="POST")(app.classify_formula)
-
-    bottle.route('/version', method="GET")(app.get_version)
-    bottle.route('/', method="GET")(app.get_version)
-
+def create_app(config="config.json"):
+    """Build the bottle application: load the models (or start loading them) and register the routes. """
+    configuration = {}
     if config and os.path.exists(config):
-
         print("Loading configuration...")
-        configuration = {}
         with open(config, 'r') as fp:
             configuration = json.load(fp)
 
-        ner = spacy.load("en_core_web_sm", disable=["parser", "textcat", "ner"])
-
-        print("Loading space groups patterns...")
-        entity_ruler_space_groups = ner.add_pipe("entity_ruler", "entity_ruler_space_groups")
-        entity_ruler_space_groups.from_disk(configuration['space-groups'])
+    service = Service(configuration)
+    app = bottle.Bottle()
 
-        print("Loading crystal structure patterns...")
-        entity_ruler_crystal_structure = ner.add_pipe("entity_ruler", "crystal_structure")
-        entity_ruler_crystal_structure.from_disk(configuration['crystal-structure'])
+    serialization_configuration = configuration.get('serialization', {})
+    if serialization_configuration.get('compression', True):
+        app.install(CompressionPlugin(min_size=serialization_configuration.get('compression-min-size', 1024),
+                                      level=serialization_configuration.get('compression-level', 6)))
 
-        bottle.route('/process/structure/text', method="POST")(app.process_structure_text)
-        app.ner = ner
+    if service.has_structure_patterns(configuration):
+        app.route('/process/structure/text', method="POST")(
+            service.requires(['spacy'], service.process_structure_text))
     else:
         print("No space groups patterns... ignoring... ")
 
+    app.route('/process/link', method="POST")(service.requires(['spacy'], service.process_link))
+    app.route('/process/material', method="POST")(service.requires(['material-parser'], service.process_material))
+    app.route('/process/material/stream', method="POST")(
+        service.requires(['material-parser'], service.process_material_stream))
+
+    app.route('/convert/name/formula', method="POST")(
+        service.requires(['formula-parser', 'spacy'], service.name_to_formula))
+    app.route('/convert/formula/composition', method="POST")(
+        service.requires(['formula-parser'], service.formula_to_composition))
+
+    app.route('/classify/tc', method="POST")(service.requires(['spacy'], service.classify_tc))
+    app.route('/classify/formula', method="POST")(service.requires(['formula-parser'], service.classify_formula))
+
+    app.route('/version', method="GET")(service.get_version)
+    app.route('/stats', method="GET")(service.get_stats)
+    app.route('/ready', method="GET")(service.get_ready)
+    app.route('/', method="GET")(service.get_version)
+
+    return app
+
+
+def run_production(host='0.0.0.0', port='8080', config="config.json", workers=None, threads=1, backlog=2048,
+                   graceful_timeout=30, timeout=300):
+    """
+    Run the service with gunicorn using pre-forked worker processes. Each worker builds its own application
+    (and therefore loads the models once) after the fork, so that TensorFlow and spaCy are never shared between
+    processes.
+        - threads: number of request threads per worker. With more than one thread, concurrent requests can be
+            coalesced by the micro-batching of the material parser
+        - backlog: maximum number of pending connections waiting to be accepted by a worker
+        - graceful_timeout: seconds given to the workers to finish the requests in progress on SIGTERM / SIGINT
+        - timeout: seconds of silence after which a worker is killed and restarted, the loading of the models
+            counts (but not the requests)
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError("The production mode requires gunicorn. Install it with 'pip install gunicorn'.")
+
+    options = {
+        'bind': "{}:{}".format(host, port),
+        'workers': workers if workers else multiprocessing.cpu_count(),
+        # With the threaded workers, the requests do not count in the timeout: the bulk streams can last longer
+        'worker_class': 'gthread',
+        'threads': threads,
+        'backlog': backlog,
+        'graceful_timeout': graceful_timeout,
+        'timeout': timeout,
+        'preload_app': False
+    }
+
+    class ProductionApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return create_app(config)
+
+    print("Starting {} workers on {}, backlog: {}".format(options['workers'], options['bind'], backlog))
+    ProductionApplication().run()
+
+
+def init(host='0.0.0.0', port='8080', config="config.json", development=False):
+    app = create_app(config)
+
     bottle.debug(True)
-    run(host=host, port=port, debug=True, reloader=development)
+    run(app=app, host=host, port=port, debug=True, reloader=development)
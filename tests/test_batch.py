@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from material_parsers.batch import find_chunks, parse_record, read_chunk, read_header, write_part, check_manifest, \
+    get_manifest
+
+
+def test_find_chunks_and_read_chunk(tmp_path):
+    input_path = tmp_path / "mentions.jsonl"
+    input_path.write_text('"MgB2"\n{"text": "LaFeO3", "id": 2}\n\nNb3Sn\n{"text": "CuO"}\n', encoding='utf-8')
+
+    chunks = find_chunks(str(input_path), chunk_size=2)
+
+    assert [lines for _, lines in chunks] == [2, 2, 1]
+    assert read_chunk(str(input_path), *chunks[0], "jsonl") == [{"text": "MgB2"}, {"text": "LaFeO3", "id": 2}]
+    assert read_chunk(str(input_path), *chunks[1], "jsonl") == [{"text": "Nb3Sn"}]
+    assert read_chunk(str(input_path), *chunks[2], "jsonl") == [{"text": "CuO"}]
+
+
+def test_read_chunk_tsv(tmp_path):
+    input_path = tmp_path / "mentions.tsv"
+    input_path.write_text('id\ttext\n1\tMgB2\n2\tLa 2-x Sr x CuO4\n', encoding='utf-8')
+
+    header, offset = read_header(str(input_path), "tsv")
+    chunks = find_chunks(str(input_path), offset, chunk_size=10)
+
+    assert header == ["id", "text"]
+    assert read_chunk(str(input_path), *chunks[0], "tsv", header) == [{"id": "1", "text": "MgB2"},
+                                                                       {"id": "2", "text": "La 2-x Sr x CuO4"}]
+
+
+def test_parse_record():
+    assert parse_record("\n", "jsonl") is None
+    assert parse_record('"MgB2"\n', "jsonl", text_field="material") == {"material": "MgB2"}
+    assert parse_record('{MgB2\n', "jsonl") == {"text": "{MgB2"}
+
+
+def test_write_part_jsonl(tmp_path):
+    path = str(tmp_path / "part-00000.jsonl")
+
+    write_part(path, [{"text": "MgB2", "materials": []}], "jsonl")
+
+    with open(path) as fp:
+        assert [json.loads(line) for line in fp] == [{"text": "MgB2", "materials": []}]
+
+
+def test_check_manifest_different_parameters(tmp_path):
+    check_manifest(str(tmp_path), {"chunk-size": 10})
+    check_manifest(str(tmp_path), {"chunk-size": 10})
+
+    with pytest.raises(ValueError):
+        check_manifest(str(tmp_path), {"chunk-size": 20})
+
+
+def test_check_manifest_different_configuration(tmp_path):
+    configuration = {"material-parser": {"length-buckets": [[8, 128]], "symbolic-substitution": False}}
+    manifest = get_manifest("mentions.jsonl", "jsonl", "jsonl", 10, "text", configuration, "resources/data/models")
+    check_manifest(str(tmp_path), manifest)
+
+    configuration = {"material-parser": {"length-buckets": [[8, 128]], "symbolic-substitution": True}}
+    with pytest.raises(ValueError):
+        check_manifest(str(tmp_path), get_manifest("mentions.jsonl", "jsonl", "jsonl", 10, "text", configuration,
+                                                   "resources/data/models"))
+
+    with pytest.raises(ValueError):
+        check_manifest(str(tmp_path), get_manifest("mentions.jsonl", "jsonl", "jsonl", 10, "text", {},
+                                                   "resources/data/other-models"))
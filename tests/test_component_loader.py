@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from material_parsers.commons.component_loader import ComponentLoader
+
+
+def test_load_synchronous():
+    loaded = []
+    target = ComponentLoader()
+
+    target.load("first", lambda: loaded.append("first"))
+    target.load("second", lambda: loaded.append("second"), requires=["first"])
+
+    assert loaded == ["first", "second"]
+    assert target.not_ready(["first", "second"]) == []
+    assert target.status()["ready"] is True
+
+
+def test_load_synchronous_error():
+    def fail():
+        raise IOError("missing model")
+
+    with pytest.raises(IOError):
+        ComponentLoader().load("model", fail)
+
+
+def test_load_background():
+    release = threading.Event()
+    target = ComponentLoader(background=True)
+
+    target.load("slow", release.wait)
+    target.load("dependent", lambda: None, requires=["slow"])
+
+    assert target.not_ready(["slow", "dependent", "unknown"]) == ["slow", "dependent"]
+    assert target.status()["components"]["slow"]["loading"] is True
+
+    release.set()
+
+    assert target.wait(timeout=5) is True
+    assert target.not_ready(["slow", "dependent"]) == []
+    assert target.status()["components"]["slow"]["load_time"] is not None
+
+
+def test_load_background_error():
+    def fail():
+        raise IOError("missing model")
+
+    target = ComponentLoader(background=True)
+
+    target.load("model", fail)
+    target.load("dependent", lambda: None, requires=["model"])
+
+    assert target.wait(timeout=5) is False
+    assert target.failed(["model", "dependent"]) == ["model", "dependent"]
+    assert "missing model" in target.status()["components"]["model"]["error"]
@@ -1,12 +1,39 @@
+import copy
 import logging
 
+import spacy
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
 from material_parsers.linking.linking_module import CriticalTemperatureClassifier, RuleBasedLinker, \
-    SpacyPipeline
+    SpacyPipeline, ParagraphAnalysis
 from tests.utils import get_tokens, get_tokens_and_spans, prepare_doc
 
 LOGGER = logging.getLogger(__name__)
 
 
+@Language.component("test_tag_only")
+def tag_only(doc):
+    for token in doc:
+        token.tag_ = "NN"
+    return doc
+
+
+@Language.component("test_tag_and_pos")
+def tag_and_pos(doc):
+    for token in doc:
+        token.tag_ = "NN"
+        token.pos_ = "NOUN"
+    return doc
+
+
+@Language.component("test_dependencies")
+def dependencies(doc):
+    for token in doc:
+        token.dep_ = "dep"
+    return doc
+
+
 class TestSpacyPipeline:
     def test_get_sentence_boundaries(self):
         input = "The relatively high superconducting transition tempera- ture in La 3 Ir 2 Ge 2 is noteworthy. " \
@@ -32,6 +59,27 @@ class TestSpacyPipeline:
 
         assert len(boundaries) == 8
 
+    def test_get_sentence_boundaries_with_offsets(self):
+        words = ["The", "Tc", "of", "MgB2", "is", "39", "K", ".", "It", "is", "high", "."]
+        spaces = [True, True, True, True, True, True, False, True, True, True, False, False]
+
+        target = SpacyPipeline(spacy.blank("en"))
+        boundaries = target.get_sentence_boundaries(words, spaces, return_offsets=True)
+
+        assert boundaries == [(0, 8, 0, 23), (8, 12, 24, 35)]
+        assert target.get_sentence_boundaries(words, spaces) == [(0, 8), (8, 12)]
+
+    def test_get_sentence_boundaries_with_offsets_leading_whitespaces(self):
+        words = ["   It", "is", "X."]
+        spaces = [True, True, False]
+        text = "   It is X."
+
+        target = SpacyPipeline(spacy.blank("en"))
+        boundaries = target.get_sentence_boundaries(words, spaces, return_offsets=True)
+
+        assert boundaries == [(0, 2, 3, 11)]
+        assert text[3:11] == "It is X."
+
 
 class TestRuleBasedLinker:
 
@@ -53,6 +101,26 @@ class TestRuleBasedLinker:
 
         print(process_paragraph)
 
+    def test_process_paragraphs_same_output_as_process_paragraph(self):
+        paragraphs = []
+        for text, input_spans in [
+            ("The LaFe0.2 Sr 0.4 was discovered to be superconducting at 3K applying a pressure of 5Gpa.",
+             [("LaFe0.2 Sr 0.4", "<material>"), ("superconducting", "<tc>"), ("3K", "<tcValue>"),
+              ("5Gpa", "<pressure>")]),
+            ("The Tc of the BaClE2 is 30K.", [("Tc", "<tc>"), ("BaClE2", "<material>"), ("30K", "<tcValue>")]),
+            ("The material MgB2 is a superconductor.", [("MgB2", "<material>")])
+        ]:
+            tokens, spans = get_tokens_and_spans(text, input_spans)
+            for span in spans:
+                span['linkable'] = True
+            paragraphs.append({"text": text, "spans": spans, "tokens": tokens})
+
+        target = RuleBasedLinker(source="<tcValue>", destination="<material>")
+
+        process_paragraphs = target.process_paragraphs(paragraphs, batch_size=2)
+
+        assert process_paragraphs == [target.process_paragraph(paragraph) for paragraph in paragraphs]
+
 
 class TestCriticalTemperatureClassifier:
     def test_markCriticalTemperature_simple_1(self):
@@ -273,6 +341,23 @@ class TestCriticalTemperatureClassifier:
 
         assert tcValues[0].text == "2.7 K"
 
+    def test_process_doc_expressions_before(self):
+        target = CriticalTemperatureClassifier(spacy.blank("en"))
+
+        for words, spaces, expected in [
+            (["measured", "at", "T=", "4 K"], [True, True, False, False], False),
+            (["measured", "at", "T", "=", "4 K"], [True, True, True, True, False], False),
+            (["It", "superconducts", "at", "4 K"], [True, True, True, False], True),
+            (["It", "Superconducts", "at", "~", "4 K"], [True, True, True, False, False], True),
+            (["It", "superconducts", "at", "4 K", "lower"], [True, True, True, True, False], False)
+        ]:
+            doc = Doc(target.nlp.vocab, words=words, spaces=spaces)
+            doc.ents = [Span(doc, words.index("4 K"), words.index("4 K") + 1, label="<tcValue>")]
+
+            target.process_doc(doc)
+
+            assert doc[words.index("4 K")]._.linkable is expected
+
     def test_mark_temperatures_process(self):
         text = "The LaFe0.2 Sr 0.4 was discovered to be superconducting at 3K applying a pressure of 5Gpa."
         input_spans = [("LaFe0.2 Sr 0.4", "<material>"), ("superconducting", "<tc>"), ("3K", "<tcValue>"),
@@ -296,6 +381,90 @@ class TestCriticalTemperatureClassifier:
         assert process_paragraph['spans'][0]['linkable'] is True
         assert process_paragraph['spans'][2]['linkable'] is True
 
+    def test_mark_temperatures_fast_same_output(self):
+        paragraphs = []
+        for text, input_spans in [
+            ("The LaFe0.2 Sr 0.4 was discovered to be superconducting at 3K applying a pressure of 5Gpa.",
+             [("LaFe0.2 Sr 0.4", "<material>"), ("superconducting", "<tc>"), ("3K", "<tcValue>"),
+              ("5Gpa", "<pressure>")]),
+            ("The Tc of the BaClE2 is 30K.", [("Tc", "<tc>"), ("BaClE2", "<material>"), ("30K", "<tcValue>")]),
+            ("The resistance of MgB2 was measured below 10 K.", [("MgB2", "<material>"), ("10 K", "<tcValue>")])
+        ]:
+            tokens, spans = get_tokens_and_spans(text, input_spans)
+            paragraphs.append({"text": text, "spans": spans, "tokens": tokens})
+
+        target = CriticalTemperatureClassifier()
+
+        fast_paragraphs = target.mark_temperatures_paragraphs(paragraphs, fast=True)
+
+        assert fast_paragraphs == [target.mark_temperatures_paragraph(paragraph) for paragraph in paragraphs]
+
+    def test_fast_classification_disabled_when_parsing_merges_phrases(self):
+        nlp = spacy.blank("en")
+        nlp.add_pipe("test_tag_only", name="tagger")
+        nlp.add_pipe("test_dependencies", name="parser")
+        assert CriticalTemperatureClassifier(nlp).fast_classification is True
+
+        nlp = spacy.blank("en")
+        nlp.add_pipe("test_tag_and_pos", name="tagger")
+        nlp.add_pipe("test_dependencies", name="parser")
+        assert CriticalTemperatureClassifier(nlp).fast_classification is False
+
+
+class TestParagraphAnalysis:
+    def test_shared_doc_same_output_as_process_paragraph(self):
+        text = "The LaFe0.2 Sr 0.4 was discovered to be superconducting at 3K applying a pressure of 5Gpa."
+        input_spans = [("LaFe0.2 Sr 0.4", "<material>"), ("superconducting", "<tc>"), ("3K", "<tcValue>"),
+                       ("5Gpa", "<pressure>")]
+        tokens, spans = get_tokens_and_spans(text, input_spans)
+        for span in spans:
+            span['links'] = []
+
+        paragraph = {
+            "text": text,
+            "spans": spans,
+            "tokens": tokens
+        }
+
+        classifier = CriticalTemperatureClassifier()
+        linker_pressure = RuleBasedLinker(source="<pressure>", destination="<tcValue>", spacy_nlp=classifier.nlp)
+        linker_material = RuleBasedLinker(source="<tcValue>", destination="<material>", spacy_nlp=classifier.nlp)
+
+        analysis = ParagraphAnalysis(classifier, paragraph)
+
+        assert classifier.mark_temperatures_analysis(analysis, spans) == classifier.mark_temperatures_paragraph(
+            paragraph)
+
+        spans[0]['linkable'] = True
+        spans[2]['linkable'] = True
+        spans[3]['linkable'] = True
+
+        for linker in [linker_pressure, linker_material, linker_pressure]:
+            assert linker.process_analysis(analysis, spans) == linker.process_paragraph(paragraph)
+
+    def test_links_are_not_kept_between_link_types(self):
+        text = "The Tc of the BaClE2 is 30K."
+        input_spans = [("Tc", "<tc>"), ("BaClE2", "<material>"), ("30K", "<tcValue>")]
+        tokens, spans = get_tokens_and_spans(text, input_spans)
+        spans[1]['linkable'] = True
+        spans[2]['linkable'] = True
+
+        paragraph = {
+            "text": text,
+            "spans": spans,
+            "tokens": tokens
+        }
+
+        linker = RuleBasedLinker(source="<tcValue>", destination="<material>")
+        analysis = ParagraphAnalysis(linker, paragraph)
+
+        first = linker.process_analysis(analysis, spans)
+        second = linker.process_analysis(analysis, spans)
+
+        assert first == second
+        assert len(second[0]['spans'][1]['links']) == 1
+        assert 'links' not in spans[1]
+
 
 class TestUtilitiesMethods:
 
@@ -359,3 +528,18 @@ class TestUtilitiesMethods:
             assert text[span['offset_start']:span['offset_end']] == span['text']
             span_tokens = outputTokens[span['token_start']:span['token_end']]
             assert ''.join([span_tokens[i] + (' ' if outputSpaces[i] else '') for i in range(0, len(span_tokens))])
+
+    def test_convert_to_spacy_does_not_modify_the_input(self):
+        text = "The Tc of the BaClE2 is 30K."
+        tokens, spans = get_tokens_and_spans(text, [("Tc", "<tc>"), ("BaClE2", "<material>"), ("30K", "<tcValue>")])
+        for span in spans:
+            span['links'] = []
+        tokens_copy = copy.deepcopy(tokens)
+        spans_copy = copy.deepcopy(spans)
+
+        outputTokens, outputSpaces, outputSpans = SpacyPipeline.convert_to_spacy(tokens, spans)
+
+        assert tokens == tokens_copy
+        assert spans == spans_copy
+        assert [(span['token_start'], span['token_end']) for span in outputSpans] == [(1, 2), (4, 6), (7, 9)]
+        assert all(output['links'] is not span['links'] for output, span in zip(outputSpans, spans))
@@ -1,6 +1,6 @@
 import logging
 
-from  material_parsers.material_parser.material2class import Material2Class
+from  material_parsers.material_parser.material2class import Material2Class, extract_elements
 
 LOGGER = logging.getLogger(__name__)
 
@@ -24,3 +24,46 @@ class TestMaterial2Class:
     def test_4(self):
         clazz = Material2Class().get_class("Te2U1")
         assert clazz == "Chalcogenides"
+
+    def test_batch(self):
+        target = Material2Class()
+        formulas = ["LaFeO2", "CuFrO2", "CO2", "Te2U1", "SrMg"]
+
+        classes = target.get_class_batch(formulas)
+
+        assert classes == [target.get_class(formula) for formula in formulas]
+        assert classes[-1] == "Alloy"
+
+    def test_batch_compositions(self):
+        classes = Material2Class().get_class_batch([{"Fe": "1", "Se": "1-x", "Te": "x"}, ["Mg", "B"], []])
+
+        assert classes == ["Iron-chalcogenides", "Borides", "Alloy"]
+
+    def test_extract_elements(self):
+        assert extract_elements("LaFeO2") == ["La", "Fe", "O"]
+        assert extract_elements("Li3Fe2(PO4)3") == ["Li", "Fe", "P", "O"]
+        assert extract_elements("Fe1.0Cu0.0O2") == ["Fe", "O"]
+        assert extract_elements("CuSO4·5H2O") == ["Cu", "S", "O", "H"]
+        assert extract_elements("NaCoO2·yH2O") == ["Na", "Co", "O", "H"]
+        assert extract_elements("(La, Sr)2CuO4") == ["La", "Sr", "Cu", "O"]
+
+    def test_extract_elements_ambiguous(self):
+        assert extract_elements("La2-xSrxCuO4") is None
+        assert extract_elements("YBa2Cu3O7-x") is None
+        assert extract_elements("D2O") is None
+        assert extract_elements("(Fe2O") is None
+        assert extract_elements("·5H2O") is None
+        assert extract_elements(" ·yH2OAs4") is None
+        assert extract_elements("CuSO4·") is None
+
+    def test_decompose_formula_paths(self):
+        target = Material2Class()
+
+        assert target.decompose_formula("MgB2") == ["Mg", "B"]
+        assert target.decompose_formula("MgB2") == ["Mg", "B"]
+        assert target.decompose_formula("YBa2Cu3O7-x") == ["Y", "Ba", "Cu", "O"]
+        assert target.decompose_formula("La2-xSrxCuO4") == []
+
+        stats = target.stats()
+        assert stats['paths'] == {"fast": 1, "pymatgen": 0, "rewritten": 1, "material_parser": 0, "failed": 1}
+        assert stats['cache']['hits'] == 1
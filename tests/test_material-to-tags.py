@@ -1,4 +1,4 @@
-from  material_parsers.material_parser.material2class import Material2Tags
+from  material_parsers.material_parser.material2class import Material2Tags, RuleSet
 
 
 class TestMaterial2Tags:
@@ -84,3 +84,35 @@ class TestMaterial2Tags:
         assert first_level[1] == 'Pnictides'
         assert len(taxonomy['Iron-pnictides']) == 0
         assert len(taxonomy['Pnictides']) == 0
+
+    def test_material2Tags_batch(self):
+        target = Material2Tags()
+        formulas = ["LaFeO2", "SrFeCu0.2", "CuFrO2CH", "CsFe2As2", "Bi2Sr2CaCu2O8", "H3S"]
+
+        taxonomies = target.get_classes_batch(formulas)
+
+        for formula, taxonomy in zip(formulas, taxonomies):
+            expected = target.get_classes(formula)
+            assert {tag: set(tags) for tag, tags in taxonomy.items()} == {tag: set(tags) for tag, tags in
+                                                                          expected.items()}
+
+    def test_material2Tags_batch_compositions(self):
+        taxonomies = Material2Tags().get_classes_batch([{"Bi": "2", "Sr": "2", "Cu": "1", "O": "6"}])
+
+        assert taxonomies[0]['Cuprates'] == ['Bi-based']
+        assert taxonomies[0]['Oxides'] == ['Transition Metal-Oxides']
+
+    def test_material2Tags_assign_tags_custom_rules(self):
+        tags = Material2Tags().assign_tags("MgB2", [{"and_compounds": ["Mg", "B"], "name": "MgB2-like"},
+                                                    {"not_compounds": ["B"], "name": "Boron free"}])
+
+        assert tags == {"MgB2-like"}
+
+    def test_material2Tags_rule_sets_symbol_bits_independent(self):
+        first = RuleSet([{"and_compounds": ["Xx"], "name": "first"}])
+        second = RuleSet([{"and_compounds": ["Yy", "O"], "name": "second"}])
+
+        assert first.symbol_bits["Xx"] == second.symbol_bits["Yy"]
+        assert "Yy" not in first.symbol_bits
+        assert second.matches(second.to_mask(["Yy", "O"])) == [True]
+        assert first.matches(first.to_mask(["Yy", "O"])) == [False]
@@ -0,0 +1,77 @@
+import multiprocessing
+
+import pytest
+
+from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas, FormulaParsingTimeout, \
+    FormulaParsingError
+
+
+def test_formula_to_composition():
+    target = MaterialParserFormulas()
+
+    composition = target.formula_to_composition("La2-xSrxCuO4")
+
+    assert composition['composition'] == {'La': '2-x', 'Sr': 'x', 'Cu': '1', 'O': '4'}
+
+
+def test_formula_to_composition_cached_results_are_copies():
+    target = MaterialParserFormulas()
+
+    composition = target.formula_to_composition("MgB2")
+    composition['code'] = 200
+
+    assert target.formula_to_composition("MgB2") == {'composition': {'Mg': '1', 'B': '2'}}
+    assert target.stats()['formula_to_composition']['hits'] == 1
+
+
+def test_formula_to_composition_without_cache():
+    target = MaterialParserFormulas(cache_size=0)
+
+    assert target.formula_to_composition("MgB2") == {'composition': {'Mg': '1', 'B': '2'}}
+    assert target.stats() == {}
+
+
+def test_formula_to_composition_with_timeout():
+    target = MaterialParserFormulas(timeout=60, processes=1)
+
+    assert target.formula_to_composition("MgB2") == {'composition': {'Mg': '1', 'B': '2'}}
+
+    target.pool.timeout = 0.00001
+    with pytest.raises(FormulaParsingTimeout):
+        target.formula_to_composition("YBa2Cu3O7")
+
+    target.pool.timeout = 60
+    assert target.formula_to_composition("NbN") == {'composition': {'Nb': '1', 'N': '1'}}
+    # The timeout is not remembered as a failure of the formula
+    assert target.formula_to_composition("YBa2Cu3O7") == {'composition': {'Y': '1', 'Ba': '2', 'Cu': '3', 'O': '7'}}
+    target.pool.shutdown()
+
+
+def test_formula_to_composition_with_short_timeout_after_restart():
+    target = MaterialParserFormulas(timeout=60, processes=1)
+
+    target.pool.timeout = 0.00001
+    with pytest.raises(FormulaParsingTimeout):
+        target.formula_to_composition("YBa2Cu3O7")
+
+    # The startup of the new process (importing text2chem, about a second) is not counted in the next call
+    target.pool.timeout = 0.5
+    assert target.formula_to_composition("MgB2") == {'composition': {'Mg': '1', 'B': '2'}}
+    target.pool.shutdown()
+
+
+def test_formula_to_composition_process_failure_not_cached():
+    target = MaterialParserFormulas(timeout=60, processes=1)
+
+    # The connection of the worker is replaced with one whose other end is closed, as when the process crashes
+    process, connection = target.pool.workers.get()
+    broken_connection, other_end = multiprocessing.Pipe()
+    other_end.close()
+    connection.close()
+    target.pool.workers.put((process, broken_connection))
+
+    with pytest.raises(FormulaParsingError):
+        target.formula_to_composition("MgB2")
+
+    assert target.formula_to_composition("MgB2") == {'composition': {'Mg': '1', 'B': '2'}}
+    target.pool.shutdown()
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from material_parsers.commons.micro_batching import MicroBatcher
+
+
+def test_submit_single_caller():
+    target = MicroBatcher(lambda batch: [item * 2 for item in batch], max_batch_size=8, max_wait_ms=1)
+
+    assert target.submit([1, 2, 3]) == [2, 4, 6]
+    assert target.submit([]) == []
+
+
+def test_submit_concurrent_callers_are_coalesced():
+    calls = []
+
+    def batch_function(batch):
+        calls.append(list(batch))
+        time.sleep(0.01)
+        return [item.upper() for item in batch]
+
+    target = MicroBatcher(batch_function, max_batch_size=100, max_wait_ms=200)
+
+    results = {}
+
+    def caller(index):
+        results[index] = target.submit(["a" + str(index), "b" + str(index)])
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i in range(5):
+        assert results[i] == ["A" + str(i), "B" + str(i)]
+
+    assert len(calls) < 5
+    stats = target.stats()
+    assert stats['items'] == 10
+    assert stats['batches'] == len(calls)
+    assert stats['max_batch_size'] == max(len(call) for call in calls)
+
+
+def test_submit_respects_max_batch_size():
+    sizes = []
+
+    def batch_function(batch):
+        sizes.append(len(batch))
+        return batch
+
+    target = MicroBatcher(batch_function, max_batch_size=2, max_wait_ms=50)
+
+    threads = [threading.Thread(target=target.submit, args=([i],)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(sizes) == 6
+    assert max(sizes) <= 2
+
+
+def test_submit_propagates_errors():
+    def batch_function(batch):
+        raise ValueError("broken model")
+
+    target = MicroBatcher(batch_function, max_batch_size=4, max_wait_ms=1)
+
+    with pytest.raises(ValueError):
+        target.submit(["a"])
@@ -1,6 +1,11 @@
-from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas
-from material_parsers.material_parser.material_parser_ml import MaterialParserML, replace_variable, \
-    expand_formula, resolve_variables, generate_permutations, cluster_by_label
+import threading
+import time
+
+import pytest
+from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas, FormulaParsingTimeout
+from material_parsers.material_parser.material_parser_ml import MaterialParserML, replace_variable, FormulaTemplate, \
+    expand_formula, resolve_variables, iterate_resolved_variables, generate_permutations, cluster_by_label, \
+    bucket_by_length
 
 
 # def test():
@@ -83,6 +88,30 @@ def test_replace_variable_error_case_1():
     assert output == "Sc"
 
 
+@pytest.mark.parametrize("formula, variable", [
+    ("Fe1-xCuxO2", "x"),
+    ("Fe-xCu1-xO2", "x"),
+    ("FexCuxO2", "x"),
+    ("LnFeAs(O1−x Fx)", "Ln"),
+    ("1-x Ru x", "x"),
+    ("RE", "RE"),
+    ("Li x (NH 3 ) 1-x Fe 2 (Te x Se 1−x ) 2", "x"),
+    ("Ba 1-x K x Fe 2-y Co y As 2", "y"),
+    ("Sr2-xLaxCuO4-x", "x"),
+    ("Mg1-xAlxB2", "xx")
+])
+@pytest.mark.parametrize("value", ["0.8", "0.05", "-0.2", "1"])
+def test_formula_template_same_as_replace_variable(formula, variable, value):
+    expected = replace_variable(formula, variable, value)
+
+    assert FormulaTemplate(formula, variable).substitute(value) == expected
+
+
+def test_formula_template_invalid_value():
+    with pytest.raises(ValueError):
+        FormulaTemplate("Fe1-xCuxO2", "x").substitute("a")
+
+
 def test_expand_formula_should_not_expand_nor_throw_exception():
     output_formulas = expand_formula("(TMTTF) 2 PF 6")
     assert len(output_formulas) == 1
@@ -183,6 +212,27 @@ def test_resolve_variable_interval():
     assert output_materials[1] == "Li 0.01 (NH 3 ) 0.99 Fe 2 (Te 0.01 Se 0.99 ) 2"
 
 
+def test_resolve_variable_duplicated_values():
+    material = {'formula': {'rawValue': "Fe1-xCuxO2"}, 'variables': {"x": ["0.1", "0.2", "0.1", "0.2"]}}
+    output_materials = resolve_variables(material)
+    assert output_materials == ["Fe0.9Cu0.1O2", "Fe0.8Cu0.2O2"]
+
+
+def test_resolve_variable_max_expansions():
+    material = {'formula': {'rawValue': "(Ba1-xKx)(Fe1-yCoy)2As2"},
+                'variables': {"x": [str(i / 1000) for i in range(1000)], "y": [str(i / 1000) for i in range(1000)]}}
+    output_materials = resolve_variables(material, max_expansions=3)
+    assert output_materials == ["(Ba1.0K0.0)(Fe1.0Co0.0)2As2", "(Ba1.0K0.0)(Fe1.0Co0.001)2As2",
+                                "(Ba1.0K0.0)(Fe1.0Co0.002)2As2"]
+
+
+def test_iterate_resolved_variables_is_lazy():
+    material = {'formula': {'rawValue': "Fe1-xCuxO2"}, 'variables': {"x": ["0.1", "0.2", "a"]}}
+    formulas = iterate_resolved_variables(material)
+    assert next(formulas) == "Fe0.9Cu0.1O2"
+    assert next(formulas) == "Fe0.8Cu0.2O2"
+
+
 def test_generate_permutations():
     formula = "Li x (NH 3 ) y Fe 2 (Te z Se 1−z ) 2"
 
@@ -304,3 +354,192 @@ def test_cluster_2():
     assert len(clusters[1]) == 1
     assert len(clusters[2]) == 1
     assert len(clusters[3]) == 1
+
+
+def test_bucket_by_length():
+    sequences = [["a"] * 100, ["a"] * 3, ["a"] * 20, ["a"] * 1, ["a"] * 1000]
+    buckets = [(5, 128), (50, 32), (None, 4)]
+
+    groups = bucket_by_length(sequences, buckets)
+
+    assert groups == [(128, [3, 1]), (32, [2]), (4, [0, 4])]
+
+
+def test_bucket_by_length_longer_than_all_buckets():
+    sequences = [["a"] * 10, ["a"] * 2]
+
+    groups = bucket_by_length(sequences, [(5, 16), (8, 4)])
+
+    assert groups == [(16, [1]), (4, [0])]
+
+
+class FakeConfig:
+    batch_size = 20
+
+
+class FakeModel:
+    def __init__(self):
+        self.model_config = FakeConfig()
+        self.calls = []
+
+    def tag(self, texts, output_format):
+        self.calls.append((self.model_config.batch_size, [len(text) for text in texts]))
+        return [[(token, 'O') for token in text] for text in texts]
+
+
+def test_tag_should_restore_input_order():
+    model = MaterialParserML(MaterialParserFormulas(), model_path=None, length_buckets=[(2, 64), (None, 8)])
+    model.model = FakeModel()
+    model.default_batch_size = 20
+    tokenized_input = [["La", "Fe", "As", "O"], ["MgB", "2"], ["Nb", "3", "Sn", "film"], ["H"]]
+
+    results = model.tag(tokenized_input)
+
+    assert [[token for token, label in result] for result in results] == tokenized_input
+    assert model.model.calls == [(64, [1, 2]), (8, [4, 4])]
+
+
+class SlowFakeModel(FakeModel):
+    def tag(self, texts, output_format):
+        batch_size = self.model_config.batch_size
+        time.sleep(0.01)
+        # The batch size must not be changed by another thread while tagging
+        self.calls.append((batch_size, self.model_config.batch_size))
+        return [[(token, 'O') for token in text] for text in texts]
+
+
+def test_tag_concurrent_calls_keep_their_batch_size():
+    model = MaterialParserML(MaterialParserFormulas(), model_path=None, length_buckets=[(2, 64), (None, 8)])
+    model.model = SlowFakeModel()
+    model.default_batch_size = 20
+
+    threads = [threading.Thread(target=model.tag, args=([["MgB", "2"], ["Nb", "3", "Sn", "film"]],))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(model.model.calls) == 8
+    assert all(before == after for before, after in model.model.calls)
+
+
+def test_process_should_use_cache():
+    model = MaterialParserML(MaterialParserFormulas(), model_path=None, cache_size=10)
+    processed = []
+
+    def process_batch(input_data, incomplete=None):
+        processed.append(list(input_data))
+        return [[{"formula": {"rawValue": text}}] for text in input_data]
+
+    model.process_batch = process_batch
+
+    first = model.process(["MgB2", "NbN"])
+    second = model.process(["NbN", "MgB2", "H3S"])
+
+    assert first == [[{"formula": {"rawValue": "MgB2"}}], [{"formula": {"rawValue": "NbN"}}]]
+    assert second == [[{"formula": {"rawValue": "NbN"}}], [{"formula": {"rawValue": "MgB2"}}],
+                      [{"formula": {"rawValue": "H3S"}}]]
+    assert processed == [["MgB2", "NbN"], ["H3S"]]
+    assert model.stats()['result_cache']['hits'] == 2
+
+
+def test_process_cache_depends_on_configuration(tmp_path):
+    cache_path = str(tmp_path / "results.sqlite")
+    processed = []
+
+    def process_batch(input_data, incomplete=None):
+        processed.append(list(input_data))
+        return [[{"formula": {"rawValue": text}}] for text in input_data]
+
+    for max_variable_expansions in [None, None, 2]:
+        model = MaterialParserML(MaterialParserFormulas(), model_path=None, cache_size=10, cache_path=cache_path,
+                                 max_variable_expansions=max_variable_expansions)
+        model.process_batch = process_batch
+        model.process(["MgB2"])
+
+    # The results cached with a different configuration are not used
+    assert processed == [["MgB2"], ["MgB2"]]
+
+
+def test_process_should_not_cache_incomplete_results():
+    model = MaterialParserML(MaterialParserFormulas(), model_path=None, cache_size=10)
+    processed = []
+
+    def process_batch(input_data, incomplete=None):
+        processed.append(list(input_data))
+        # The formulas of the first sentence timed out
+        incomplete.add(0)
+        return [[{"formula": {"rawValue": text}}] for text in input_data]
+
+    model.process_batch = process_batch
+
+    model.process(["MgB2", "NbN"])
+    model.process(["MgB2", "NbN"])
+
+    assert processed == [["MgB2", "NbN"], ["MgB2"]]
+
+
+def test_extract_results_timeout_incomplete():
+    class TimeoutFormulaParser(MaterialParserFormulas):
+        def formula_to_composition(self, formula):
+            raise FormulaParsingTimeout("The parsing of " + formula + " took more than 1 seconds.")
+
+    output = [
+        [{'text': 'powders', 'class': '<shape>'}],
+        [{'text': 'MgB2', 'class': '<formula>'}]
+    ]
+    incomplete = set()
+
+    entities = MaterialParserML(TimeoutFormulaParser(cache_size=0), model_path=None).extract_results(
+        output, incomplete=incomplete)
+
+    assert entities[1][0]['resolvedFormulas'] == [{'rawValue': 'MgB2'}]
+    assert incomplete == {1}
+
+
+def test_extract_results_symbolic_substitution_same_compositions():
+    output = [
+        [
+            {'text': '(Ba1-xKx)(Fe1-yCoy)2As2', 'class': '<formula>'},
+            {'text': 'x', 'class': '<variable>'},
+            {'text': '0.1, 0.2, 0.4', 'class': '<value>'},
+            {'text': 'y', 'class': '<variable>'},
+            {'text': '0.08, 0.125', 'class': '<value>'}
+        ],
+        [
+            {'text': 'Dy1-yCayBa2Cu3O7', 'class': '<formula>'},
+            {'text': 'y', 'class': '<variable>'},
+            {'text': '0.1, 0.2', 'class': '<value>'}
+        ]
+    ]
+    expected = MaterialParserML(MaterialParserFormulas(), model_path=None).extract_results(output)
+    model = MaterialParserML(MaterialParserFormulas(), model_path=None, symbolic_substitution=True)
+
+    entities = model.extract_results(output)
+
+    assert entities == expected
+    assert len(entities[0][0]['resolvedFormulas']) == 6
+    # The formulas with y=0.125 are parsed, the variable y of Dy1-yCay... is substituted in the element as well
+    assert model.stats()['symbolic_compositions'] == 3
+
+
+def test_extract_results_max_variable_expansions():
+    output = [
+        [
+            {'text': 'Fe1-xCuxO2', 'class': '<formula>'},
+            {'text': 'x', 'class': '<variable>'},
+            {'text': '0.1, 0.2, 0.3', 'class': '<value>'}
+        ]
+    ]
+
+    entities = MaterialParserML(MaterialParserFormulas(), model_path=None).extract_results(output)
+    assert len(entities[0][0]['resolvedFormulas']) == 3
+    assert 'resolvedFormulasTruncated' not in entities[0][0]
+
+    model = MaterialParserML(MaterialParserFormulas(), model_path=None, max_variable_expansions=2)
+    entities = model.extract_results(output)
+    assert [formula['rawValue'] for formula in entities[0][0]['resolvedFormulas']] == ["Fe0.9Cu0.1O2",
+                                                                                       "Fe0.8Cu0.2O2"]
+    assert entities[0][0]['resolvedFormulasTruncated'] is True
+    assert model.stats()['truncated_variable_expansions'] == 1
@@ -1,5 +1,8 @@
 import logging
 
+import spacy
+from spacy.tokens import Doc
+
 from  material_parsers.linking.relationships_resolver import SimpleResolutionResolver, \
     VicinityResolutionResolver
 from tests.utils import prepare_doc
@@ -466,3 +469,36 @@ class TestVicinityResolutionResolver:
         assert len(distances) == 2
         assert distances[materials[0]][tc_values[0]] == 27.0
         assert distances[materials[1]][tc_values[0]] == 23.5
+
+    def test_find_relationships_optimal_assignment(self):
+        words = ["5K", "and", "MgB2", "NbN", "9K"]
+        doc = Doc(spacy.blank("en").vocab, words=words, spaces=[True] * len(words))
+        materials = [doc[2], doc[3]]
+
+        for assignment, expected in [("greedy", [("MgB2", "9K"), ("NbN", "5K")]),
+                                     ("optimal", [("MgB2", "5K"), ("NbN", "9K")])]:
+            tc_values = [doc[0], doc[4]]
+            for token in materials + tc_values:
+                token._.links = []
+
+            relationships = VicinityResolutionResolver(assignment).find_relationships(doc, materials, tc_values)
+
+            assert [(material.text, tc.text) for material, tc in relationships] == expected
+
+    def test_calculate_distances_parenthesis_within_token(self):
+        words = ["MgB2", "(Tc", "=", "39", "K)", "and", "NbN", "(", "16", "K", ")"]
+        spaces = [True, True, True, True, True, True, True, False, True, False, False]
+        doc = Doc(spacy.blank("en").vocab, words=words, spaces=spaces)
+
+        materials = [doc[0], doc[6]]
+        tc_values = [doc[3], doc[8]]
+
+        target = VicinityResolutionResolver()
+
+        distances = target.calculate_distances(materials, tc_values, doc)
+
+        # The first tc is not wrapped by parenthesis tokens ("(Tc" and "K)"), the second one is
+        assert distances[materials[0]][tc_values[0]] == 10.0
+        assert distances[materials[1]][tc_values[0]] == 21.0
+        assert distances[materials[0]][tc_values[1]] == 41.0
+        assert distances[materials[1]][tc_values[1]] == 0.0
@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+from material_parsers.commons.result_cache import ResultCache, Memoizer
+
+
+def test_get_missing():
+    target = ResultCache(max_size=10)
+
+    assert target.get("MgB2") is None
+    assert target.stats()['misses'] == 1
+
+
+def test_get_returns_identical_copy():
+    target = ResultCache(max_size=10)
+    result = [{"formula": {"rawValue": "MgB2"}, "resolvedFormulas": [{"rawValue": "MgB2", "formulaComposition": {
+        "Mg": "1", "B": "2"}}]}]
+    target.put("MgB2", result)
+
+    cached = target.get("MgB2")
+    assert json.dumps(cached) == json.dumps(result)
+
+    cached[0]['formula']['rawValue'] = "changed"
+    assert target.get("MgB2")[0]['formula']['rawValue'] == "MgB2"
+    assert target.stats()['hits'] == 2
+
+
+def test_put_evicts_least_recently_used():
+    target = ResultCache(max_size=2)
+    target.put("a", [1])
+    target.put("b", [2])
+    target.get("a")
+    target.put("c", [3])
+
+    assert target.get("b") is None
+    assert target.get("a") == [1]
+    assert target.get("c") == [3]
+    assert target.stats()['size'] == 2
+
+
+def test_namespace_separates_entries():
+    target = ResultCache(max_size=10, namespace="model-1")
+    target.put("MgB2", [1])
+
+    assert ResultCache(max_size=10, namespace="model-2").key("MgB2") != target.key("MgB2")
+
+
+def test_disk_tier_survives_restart(temp_dir):
+    path = str(temp_dir / "cache.sqlite")
+    ResultCache(max_size=10, namespace="model", path=path).put("La2-xSrxCuO4", [{"formula": {"rawValue": "x"}}])
+
+    target = ResultCache(max_size=10, namespace="model", path=path)
+
+    assert target.get("La2-xSrxCuO4") == [{"formula": {"rawValue": "x"}}]
+    assert target.stats()['disk_hits'] == 1
+    assert target.get("La2-xSrxCuO4") == [{"formula": {"rawValue": "x"}}]
+    assert target.stats()['hits'] == 1
+
+
+def test_memoizer_should_call_function_once():
+    calls = []
+
+    def function(formula):
+        calls.append(formula)
+        return {"composition": {"Mg": "1", "B": "2"}}
+
+    target = Memoizer(function, max_size=10)
+
+    first = target("MgB2")
+    first['code'] = 200
+    second = target("MgB2")
+
+    assert calls == ["MgB2"]
+    assert second == {"composition": {"Mg": "1", "B": "2"}}
+    assert target.stats()['hits'] == 1
+    assert target.stats()['misses'] == 1
+
+
+def test_memoizer_should_cache_errors():
+    calls = []
+
+    def function(formula):
+        calls.append(formula)
+        raise ValueError("cannot parse " + formula)
+
+    target = Memoizer(function, max_size=10)
+
+    for _ in range(3):
+        with pytest.raises(ValueError, match="cannot parse ###"):
+            target("###")
+
+    assert calls == ["###"]
+    assert target.stats()['negative_hits'] == 2
+
+
+def test_memoizer_should_not_cache_other_errors():
+    calls = []
+
+    def function(formula):
+        calls.append(formula)
+        raise IndexError()
+
+    target = Memoizer(function, max_size=10)
+
+    for _ in range(2):
+        with pytest.raises(IndexError):
+            target("###")
+
+    assert len(calls) == 2
+
+
+def test_memoizer_is_bounded():
+    target = Memoizer(lambda x: x, max_size=2)
+    for value in ["a", "b", "c", "a"]:
+        target(value)
+
+    assert target.stats()['size'] == 2
+    assert target.stats()['misses'] == 4
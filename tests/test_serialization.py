@@ -0,0 +1,98 @@
+import gzip
+import io
+import json
+import zlib
+
+import bottle
+import pytest
+
+from material_parsers.commons.compression import select_encoding, CompressionPlugin
+from material_parsers.commons.serialization import JsonSerializer
+
+
+@pytest.mark.parametrize("library", [JsonSerializer.AUTO, JsonSerializer.STANDARD])
+def test_dumps_compact(library):
+    target = JsonSerializer(library)
+    data = {"composition": {"Mo": "0.816", "B": "x"}, "classes": ["Alloys"], "code": 200}
+
+    output = target.dumps(data)
+
+    assert " " not in output
+    assert json.loads(output) == data
+    assert target.loads(output) == data
+
+
+def test_dumps_pretty():
+    assert JsonSerializer().dumps({"a": [1]}, pretty=True) == json.dumps({"a": [1]}, indent=4)
+
+
+def test_dumps_unsupported_by_orjson():
+    assert json.loads(JsonSerializer().dumps({"value": 2 ** 70})) == {"value": 2 ** 70}
+
+
+@pytest.mark.parametrize("library", [JsonSerializer.AUTO, JsonSerializer.STANDARD])
+def test_dumps_non_finite_floats(library):
+    data = {"values": [float("nan"), float("inf"), None], "code": 200}
+
+    assert JsonSerializer(library).dumps(data) == json.dumps(data, separators=(',', ':'))
+
+
+def test_loads_invalid_input():
+    with pytest.raises(ValueError):
+        JsonSerializer().loads("{invalid")
+
+
+def test_unknown_library():
+    with pytest.raises(ValueError):
+        JsonSerializer("simplejson")
+
+
+def test_select_encoding():
+    assert select_encoding("gzip, deflate, br") == "gzip"
+    assert select_encoding("deflate") == "deflate"
+    assert select_encoding("gzip;q=0.5, deflate") == "deflate"
+    assert select_encoding("gzip;q=0, *") == "deflate"
+    assert select_encoding("identity") is None
+    assert select_encoding("") is None
+
+
+def call_app(app, accept_encoding):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+               'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(),
+               'HTTP_ACCEPT_ENCODING': accept_encoding}
+    headers = {}
+
+    def start_response(status, header_list, exc_info=None):
+        headers.update(header_list)
+
+    body = b"".join(app(environ, start_response))
+    return headers, body
+
+
+def test_compression_plugin():
+    app = bottle.Bottle()
+    app.install(CompressionPlugin(min_size=100))
+    app.route('/', method="GET")(lambda: "MgB2 " * 100)
+
+    headers, body = call_app(app, "gzip")
+    assert headers['Content-Encoding'] == "gzip"
+    assert gzip.decompress(body) == b"MgB2 " * 100
+
+    headers, body = call_app(app, "deflate")
+    assert headers['Content-Encoding'] == "deflate"
+    assert zlib.decompress(body) == b"MgB2 " * 100
+
+    headers, body = call_app(app, "")
+    assert 'Content-Encoding' not in headers
+    assert body == b"MgB2 " * 100
+
+
+def test_compression_plugin_small_response():
+    app = bottle.Bottle()
+    app.install(CompressionPlugin(min_size=100))
+    app.route('/', method="GET")(lambda: "MgB2")
+
+    headers, body = call_app(app, "gzip")
+
+    assert 'Content-Encoding' not in headers
+    assert body == b"MgB2"
@@ -0,0 +1,37 @@
+import spacy
+
+from material_parsers.commons.spacy_pipelines import SpacyPipelineManager
+
+
+def create_model(path):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer", name="parser")
+    ner = nlp.add_pipe("entity_ruler", name="ner")
+    ner.add_patterns([{"label": "NER", "pattern": "cubic"}])
+    nlp.to_disk(path)
+
+    return str(path)
+
+
+def test_views_share_the_model(tmp_path):
+    patterns_path = tmp_path / "patterns.jsonl"
+    patterns_path.write_text('{"label": "crystal-structure", "pattern": "cubic"}\n')
+
+    target = SpacyPipelineManager(create_model(tmp_path / "model"))
+    target.add_entity_ruler("crystal_structure", str(patterns_path))
+    target.add_default_views()
+
+    linking = target.get_view(SpacyPipelineManager.LINKING)
+    structure = target.get_view(SpacyPipelineManager.STRUCTURE)
+
+    assert linking.pipe_names == ["parser"]
+    assert structure.pipe_names == ["crystal_structure"]
+    assert linking.vocab is structure.vocab
+    assert linking.get_pipe("parser") is target.nlp.get_pipe("parser")
+
+    doc = structure("The cubic phase")
+    assert [(ent.text, ent.label_) for ent in doc.ents] == [("cubic", "crystal-structure")]
+
+    doc = next(linking.pipe(["The cubic phase. The hexagonal phase."]))
+    assert len(list(doc.sents)) == 2
+    assert doc.ents == ()
@@ -0,0 +1,40 @@
+import io
+
+from material_parsers.commons.streaming import iter_lines, parse_text_line, iter_batches, is_chunked_body_undecoded
+
+
+def test_iter_lines():
+    stream = io.BytesIO("first line\r\nsecond line\n\nlast line".encode('utf-8'))
+
+    assert list(iter_lines(stream, chunk_size=4)) == ["first line", "second line", "", "last line"]
+
+
+def test_iter_lines_multibyte_character_across_chunks():
+    stream = io.BytesIO("Tc = 4 K\nθ-phase\n".encode('utf-8'))
+
+    assert list(iter_lines(stream, chunk_size=1)) == ["Tc = 4 K", "θ-phase"]
+
+
+def test_iter_lines_content_length():
+    stream = io.BytesIO(b"MgB2\nLaFeO\ntrailing data")
+
+    assert list(iter_lines(stream, content_length=11, chunk_size=3)) == ["MgB2", "LaFeO"]
+
+
+def test_parse_text_line():
+    assert parse_text_line('"MgB2"') == "MgB2"
+    assert parse_text_line('{"text": "La 2-x Sr x CuO4", "id": 3}') == "La 2-x Sr x CuO4"
+    assert parse_text_line('MgB2') == "MgB2"
+    assert parse_text_line('{not json') == "{not json"
+    assert parse_text_line('  ') is None
+
+
+def test_iter_batches():
+    assert list(iter_batches(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_batches([], 2)) == []
+
+
+def test_is_chunked_body_undecoded():
+    assert is_chunked_body_undecoded({'HTTP_TRANSFER_ENCODING': 'chunked', 'SERVER_SOFTWARE': 'WSGIServer/0.2'})
+    assert not is_chunked_body_undecoded({'HTTP_TRANSFER_ENCODING': 'chunked', 'SERVER_SOFTWARE': 'gunicorn/21.2.0'})
+    assert not is_chunked_body_undecoded({'CONTENT_LENGTH': '10', 'SERVER_SOFTWARE': 'WSGIServer/0.2'})
@@ -0,0 +1,57 @@
+import pytest
+
+from material_parsers.material_parser.material_parser_formulas import MaterialParserFormulas
+from material_parsers.material_parser.symbolic_composition import SymbolicComposition, format_amount, parse_value
+
+
+def test_format_amount():
+    assert format_amount(2.0) == "2"
+    assert format_amount(1.84) == "1.84"
+    assert format_amount(0.0) == "0"
+    assert format_amount(-0.0) == "0"
+    assert format_amount(0.12345) == "0.123"
+
+
+def test_parse_value():
+    assert parse_value("0.1") == 0.1
+    assert parse_value(" 2 ") == 2.0
+    assert parse_value("0.125") is None
+    assert parse_value("-0.1") is None
+    assert parse_value("0.1-0.2") is None
+
+
+def test_compile_missing_variable():
+    # The oxygen deficiency is not part of the composition
+    assert SymbolicComposition.compile({'Y': '1', 'Ba': '2', 'Cu': '3', 'O': '7'}, ["x"]) is None
+    assert SymbolicComposition.compile({'Fe': '1-x', 'Cu': 'z'}, ["x"]) is None
+
+
+def test_evaluate():
+    target = SymbolicComposition.compile({'Ba': '1-x', 'K': 'x', 'Fe': '2-2*y', 'Co': '2*y', 'As': '2'}, ["x", "y"])
+
+    compositions = target.evaluate([{"x": "0.4", "y": "0.08"}, {"x": "0.125", "y": "0.08"}, {"x": "2", "y": "0"}])
+
+    assert list(compositions[0].items()) == [('Ba', '0.6'), ('K', '0.4'), ('Fe', '1.84'), ('Co', '0.16'),
+                                             ('As', '2')]
+    assert compositions[1] is None
+    assert compositions[2] is None
+
+
+@pytest.mark.parametrize("formula, assignments, substituted_formulas", [
+    ("Fe1-xCuxO2", [{"x": "0"}, {"x": "0.1"}, {"x": "0.33"}], ["Fe1.0Cu0O2", "Fe0.9Cu0.1O2", "Fe0.67Cu0.33O2"]),
+    ("La2-xSrxCuO4", [{"x": "0.05"}, {"x": "1"}], ["La1.95Sr0.05CuO4", "La1.0Sr1CuO4"]),
+    ("Ca10(Pt4As8)(Fe2-xPtxAs2)5", [{"x": "0.5"}], ["Ca10(Pt4As8)(Fe1.5Pt0.5As2)5"]),
+    ("Li1+xTi2-xO4", [{"x": "0.33"}], ["Li1+0.33Ti1.67O4"]),
+    ("(Ba1-xKx)(Fe1-yCoy)2As2", [{"x": "0.4", "y": "0.08"}, {"x": "0", "y": "0.5"}],
+     ["(Ba0.6K0.4)(Fe0.92Co0.08)2As2", "(Ba1.0K0)(Fe0.5Co0.5)2As2"]),
+])
+def test_evaluate_same_as_parsing(formula, assignments, substituted_formulas):
+    parser = MaterialParserFormulas(cache_size=0)
+    target = SymbolicComposition.compile(parser.formula_to_composition(formula)['composition'],
+                                         list(assignments[0].keys()))
+
+    compositions = target.evaluate(assignments)
+
+    for composition, substituted_formula in zip(compositions, substituted_formulas):
+        expected = parser.formula_to_composition(substituted_formula)['composition']
+        assert list(composition.items()) == list(expected.items())
@@ -1,4 +1,7 @@
-from material_parsers.commons.utils import rewrite_comparison_symbol
+import difflib
+
+from material_parsers.commons.utils import rewrite_comparison_symbol, replace_with_closest, \
+    build_closest_character_table, ALLOWED_CHARS_MATERIAL_PARSER
 
 
 def test_rewrite_comparison_symbol_should_not_rewrite():
@@ -11,3 +14,30 @@ def test_rewrite_comparison_symbol_should_rewrite():
 
 def test_rewrite_comparison_symbol_should_rewrite2():
     assert rewrite_comparison_symbol("123231212110 <") == "> 123231212110"
+
+
+def replace_with_closest_difflib(input_string, allowed_chars, cutoff=0.8):
+    result = []
+    for char in input_string:
+        closest_match = difflib.get_close_matches(char, allowed_chars, n=1, cutoff=cutoff)
+        result.append(closest_match[0] if closest_match else char)
+    return "".join(result)
+
+
+def test_replace_with_closest_should_match_difflib():
+    corpus = ["YBa2Cu3O7−δ", "La2−xSrxCuO4", "MgB 2", "Ba1-xKxFe2As2", "LaO1ÀxFxFeAs", "Sr 2 RuO 4 ¼",
+              "(Ba1−xKx)(Fe1−yCoy)2As2", "Nb 3 Sn ͑film͒", "CeCu 2 Si 2 Ϸ", "H₃S", "Tl₂Ba₂CuO₆₊δ", ""]
+    corpus.append("".join(chr(code_point) for code_point in range(0x3000)))
+
+    for input_string in corpus:
+        assert replace_with_closest(input_string, ALLOWED_CHARS_MATERIAL_PARSER) == \
+               replace_with_closest_difflib(input_string, ALLOWED_CHARS_MATERIAL_PARSER)
+
+
+def test_build_closest_character_table_multi_characters_entries():
+    allowed_chars = ['ab', 'c', 'xyz']
+    table = build_closest_character_table(allowed_chars, cutoff=0.6)
+
+    input_string = "abcdxyz"
+    assert input_string.translate(table) == replace_with_closest_difflib(input_string, allowed_chars, cutoff=0.6)
+    assert input_string.translate(table) == "ababcdxyz"